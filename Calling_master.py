@@ -8,6 +8,7 @@ from torchvision import transforms, models
 from torch.utils.data import DataLoader
 from PIL import Image
 from Classification_helper import verify_model
+from Data_helper import loader_config
 
 CLASSDICT = {
     'species': 31,
@@ -152,12 +153,15 @@ def train_model(model, criterion, optimizer, scheduler, dataloaders, dataset_siz
 
 
 # Load train, test and validation data by phase. Phase = train, val and test. Target = genus and species
-def load_data(phase, target, d_transfroms, batch_size=16):
+# loader_kwargs are passed to the DataLoader, see Data_helper.loader_config. Defaults to the auto configuration.
+def load_data(phase, target, d_transfroms, batch_size=16, loader_kwargs=None):
     data_path = './Metadata/' + target + '_' + phase + '.csv'
     src_path = './Plaindata'
     data_out = CustomImageDataset(data_path, src_path, d_transfroms)
     data_size = len(data_out)
-    data_loader = DataLoader(data_out, batch_size=batch_size, shuffle=True)
+    if loader_kwargs is None:
+        loader_kwargs = loader_config()
+    data_loader = DataLoader(data_out, batch_size=batch_size, shuffle=True, **loader_kwargs)
     return data_loader, data_size
 
 
@@ -212,50 +216,52 @@ Sample Mean and Std in (r,g,b) from validation set
 Could increase accuracy
 '''
 
-data_transforms = transforms.Compose([transforms.Resize([256, 256]),
-                                      transforms.CenterCrop([224, 224]),
-                                      transforms.ToTensor(),
-                                      transforms.Normalize(
-                                          mean=[0.485, 0.456, 0.406],
-                                          std=[0.229, 0.224, 0.225])])
-target = 'species'
-dataloaders = {}
-dataset_sizes = {}
-batch_size: int = 16
-# dataloaders['train'], dataset_sizes['train'] = load_data('train', target, data_transforms, batch_size)
-# dataloaders['val'], dataset_sizes['val'] = load_data('val', target, data_transforms, batch_size)
-dataloaders['test'], dataset_sizes['test'] = load_data('test', target, data_transforms, batch_size)
-#
-# print(dataset_sizes)
-#
-# train_features, train_labels, train_path = next(iter(dataloaders['train']))
-# print(f"Feature batch shape: {train_features.size()}")
-# print(f"Labels batch shape: {train_labels.size()}")
-
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
-model_ft = models.resnet18(pretrained=True)
-num_ftrs = model_ft.fc.in_features
-model_ft.fc = torch.nn.Linear(num_ftrs, CLASSDICT[target])
-# model_ft.load_state_dict(torch.load(MODELPATH, map_location=torch.device(device)))
-#
-# verify_model(model_ft, dataloaders['test'], device, target, dataset_sizes['test'])
-
-# test_model(model_ft, MODELPATH, dataloaders['test'], dataset_sizes['test'], device, target)
-
-# Observe that all parameters are being optimized
-optimizer_ft = torch.optim.SGD(model_ft.parameters(), lr=0.001, momentum=0.9)
-'''Need a parameter searching grid'''
-# optimizer_ft = torch.optim.ASGD(model_ft.parameters(), lr=0.001,lambd=0.0002)
-# Decay LR by a factor of 0.1 every 7 epochs
-exp_lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer_ft, step_size=5, gamma=0.1)
-
-# result = tune.run(
-#     partial(std_call_train,
-#     model=model_ft),
-#     resources_per_trial={"cpu": 20, "gpu": 1},
-#     config=config)
-
-# test_model(model_ft, './Models/0.91_acc.pth', dataloaders['test'], dataset_sizes['test'], device, target)
-criterion = torch.nn.CrossEntropyLoss()
-model_ft = single_train(model_ft, 'species', 16, 25, criterion, optimizer_ft, exp_lr_scheduler)
+# Guarded so that DataLoader workers started with spawn do not run the training again
+if __name__ == '__main__':
+    data_transforms = transforms.Compose([transforms.Resize([256, 256]),
+                                          transforms.CenterCrop([224, 224]),
+                                          transforms.ToTensor(),
+                                          transforms.Normalize(
+                                              mean=[0.485, 0.456, 0.406],
+                                              std=[0.229, 0.224, 0.225])])
+    target = 'species'
+    dataloaders = {}
+    dataset_sizes = {}
+    batch_size: int = 16
+    # dataloaders['train'], dataset_sizes['train'] = load_data('train', target, data_transforms, batch_size)
+    # dataloaders['val'], dataset_sizes['val'] = load_data('val', target, data_transforms, batch_size)
+    dataloaders['test'], dataset_sizes['test'] = load_data('test', target, data_transforms, batch_size)
+    #
+    # print(dataset_sizes)
+    #
+    # train_features, train_labels, train_path = next(iter(dataloaders['train']))
+    # print(f"Feature batch shape: {train_features.size()}")
+    # print(f"Labels batch shape: {train_labels.size()}")
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    model_ft = models.resnet18(pretrained=True)
+    num_ftrs = model_ft.fc.in_features
+    model_ft.fc = torch.nn.Linear(num_ftrs, CLASSDICT[target])
+    # model_ft.load_state_dict(torch.load(MODELPATH, map_location=torch.device(device)))
+    #
+    # verify_model(model_ft, dataloaders['test'], device, target, dataset_sizes['test'])
+
+    # test_model(model_ft, MODELPATH, dataloaders['test'], dataset_sizes['test'], device, target)
+
+    # Observe that all parameters are being optimized
+    optimizer_ft = torch.optim.SGD(model_ft.parameters(), lr=0.001, momentum=0.9)
+    '''Need a parameter searching grid'''
+    # optimizer_ft = torch.optim.ASGD(model_ft.parameters(), lr=0.001,lambd=0.0002)
+    # Decay LR by a factor of 0.1 every 7 epochs
+    exp_lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer_ft, step_size=5, gamma=0.1)
+
+    # result = tune.run(
+    #     partial(std_call_train,
+    #     model=model_ft),
+    #     resources_per_trial={"cpu": 20, "gpu": 1},
+    #     config=config)
+
+    # test_model(model_ft, './Models/0.91_acc.pth', dataloaders['test'], dataset_sizes['test'], device, target)
+    criterion = torch.nn.CrossEntropyLoss()
+    model_ft = single_train(model_ft, 'species', 16, 25, criterion, optimizer_ft, exp_lr_scheduler)
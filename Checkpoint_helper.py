@@ -0,0 +1,133 @@
+import os
+import random
+import queue
+import threading
+
+import numpy as np
+import torch
+
+''' Periodic training checkpoints, so a crashed run can continue where it stopped. '''
+''' Functions included:
+    1. Snapshot of the training state (model, optimizer, scheduler, epoch, early stopping counters and RNG states)
+       copied to cpu memory.
+    2. A background writer thread saving snapshots to disk, the training loop never waits for the disk.
+    3. Loading a checkpoint and restoring the training state from it.
+'''
+
+
+def _to_cpu(obj):
+    """
+    Recursive copy of a (nested) state dict with every tensor cloned into cpu memory.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(epoch, model, optimizer, scheduler, best_acc, best_model_wts, sluggish, timelist, stopped=False):
+    """
+    Copy the training state after an epoch to cpu memory. The copy is independent of the live training state, so it
+    can be written by another thread while training continues.
+    :param stopped: Whether training stopped early after this epoch, a resumed run then does not train further.
+    :return: Dictionary, the checkpoint.
+    """
+    return {
+        'epoch': epoch,
+        'model': _to_cpu(model.state_dict()),
+        'optimizer': _to_cpu(optimizer.state_dict()),
+        'scheduler': _to_cpu(scheduler.state_dict()),
+        'best_acc': _to_cpu(best_acc),
+        'best_model_wts': _to_cpu(best_model_wts),
+        'sluggish': sluggish,
+        'timelist': list(timelist),
+        'stopped': stopped,
+        'rng': rng_state()
+    }
+
+
+def load_checkpoint(checkpoint_path, model, optimizer, scheduler, device):
+    """
+    Restore model, optimizer, scheduler and RNG states from a checkpoint.
+    :param checkpoint_path: Path of a checkpoint written by AsyncCheckpointWriter.
+    :return: Dictionary with the remaining training state: epoch, best_acc, best_model_wts, sluggish, timelist and
+    stopped (missing in checkpoints of older versions).
+    """
+    try:
+        # Checkpoints hold numpy and python RNG states, which the weights_only loader of recent torch refuses
+        checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only argument
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    scheduler.load_state_dict(checkpoint['scheduler'])
+    set_rng_state(checkpoint['rng'])
+    print('Resumed from {} after epoch {}.'.format(checkpoint_path, checkpoint['epoch']))
+    return checkpoint
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints with torch.save on a background thread. Only the latest pending snapshot is kept: if the disk
+    is slower than the training, an older snapshot that has not been written yet is replaced by the new one.
+    Files are written to a temporary name first and renamed, a crash during writing keeps the previous checkpoint.
+    """
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.error = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            state = self._queue.get()
+            if state is None:
+                break
+            try:
+                directory = os.path.dirname(self.checkpoint_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                tmp_path = self.checkpoint_path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, self.checkpoint_path)
+            except Exception as e:
+                self.error = e
+                print('Writing checkpoint failed: ' + str(e))
+
+    def submit(self, state):
+        """
+        Queue a snapshot for writing, replacing a snapshot still waiting in the queue.
+        :param state: Checkpoint dictionary from snapshot().
+        """
+        try:
+            self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._queue.put(state)
+
+    def close(self):
+        """
+        Wait until the pending snapshot is written and stop the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
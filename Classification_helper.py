@@ -1,14 +1,19 @@
 import os
 
+import numpy as np
 import pandas as pd
 import time
-import torch
+import json
 import csv
-from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
-from matplotlib import pyplot as plt
-import seaborn as sn
 from tqdm import tqdm
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Parquet output of verify_model is optional
+    pa = pq = None
+
 PATH = './Models/0.91_acc.pth'
 
 ''' This is the script for saving model and classification result: '''
@@ -47,83 +52,270 @@ def extract_class_label(target):
     return all_classes
 
 
-# Classify image and write the results into
-def verify_model(model, test_loader, device, target, data_size, model_name):
+def _result_columns(top_k):
+    columns = ['path', 'label', 'prediction']
+    for k in range(1, top_k + 1):
+        columns += ['top{}_class'.format(k), 'top{}_probability'.format(k)]
+    return columns
+
+
+class ResultWriter:
+    """
+    Streams the classification results of verify_model to a headerless csv, or to a Parquet file when pyarrow is
+    installed. Columns ending in _probability are floats, the others strings.
+    """
+    def __init__(self, path, columns, output_format='csv'):
+        self.path = path
+        self.columns = columns
+        self.output_format = output_format
+        if output_format == 'parquet':
+            if pq is None:
+                raise ImportError('Parquet output needs pyarrow, install it or use the csv output.')
+            schema = pa.schema([(c, pa.float32() if c.endswith('_probability') else pa.string())
+                                for c in self.columns])
+            self._writer = pq.ParquetWriter(path, schema)
+        elif output_format == 'csv':
+            self._file = open(path, 'w', encoding='ascii', errors='ignore', newline='')
+            self._writer = csv.writer(self._file)
+        else:
+            raise ValueError('Unsupported output format: {}'.format(output_format))
+
+    def write(self, columns):
+        """
+        :param columns: List of equally long column arrays, in the order of self.columns.
+        """
+        if self.output_format == 'parquet':
+            self._writer.write_table(pa.table(dict(zip(self.columns, columns))))
+        else:
+            self._writer.writerows(zip(*columns))
+
+    def close(self):
+        if self.output_format == 'parquet':
+            self._writer.close()
+        else:
+            self._file.close()
+
+
+def classification_metrics(confusion, class_names, top5_corrects):
+    """
+    Metrics of a confusion matrix.
+    :param confusion: Integer array [classes, classes], rows are the real labels and columns the predictions.
+    :param class_names: Class names by label.
+    :param top5_corrects: Number of images whose label is among the five most probable classes.
+    :return: Dictionary with top1, top5 and per class precision, recall, f1 and support.
+    """
+    confusion = np.asarray(confusion, dtype=np.float64)
+    total = confusion.sum()
+    correct = np.diag(confusion)
+    predicted = confusion.sum(0)
+    support = confusion.sum(1)
+    # Classes never predicted or never present get 0 instead of nan
+    precision = np.divide(correct, predicted, out=np.zeros_like(correct), where=predicted > 0)
+    recall = np.divide(correct, support, out=np.zeros_like(correct), where=support > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(correct),
+                   where=precision + recall > 0)
+    per_class = {name: {'precision': round(float(p), 6), 'recall': round(float(r), 6), 'f1': round(float(f), 6),
+                        'support': int(n)}
+                 for name, p, r, f, n in zip(class_names, precision, recall, f1, support)}
+    return {'images': int(total),
+            'top1': round(float(correct.sum() / total), 6) if total else 0.0,
+            'top5': round(float(top5_corrects / total), 6) if total else 0.0,
+            'macro_f1': round(float(f1[support > 0].mean()), 6) if (support > 0).any() else 0.0,
+            'per_class': per_class}
+
+
+class MetricsAccumulator:
+    """
+    Confusion matrix and top-5 hits of one model, accumulated batch by batch.
+    """
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.confusion = None
+        self.top5_corrects = 0
+
+    def update(self, scores, labels):
+        """
+        :param scores: Cpu tensor [batch, classes] of logits or probabilities.
+        :param labels: Cpu int64 tensor of the real labels.
+        :return: The predicted labels, int64 tensor.
+        """
+        predictions = scores.argmax(1)
+        counts = (labels * self.n_classes + predictions).bincount(minlength=self.n_classes * self.n_classes)
+        self.confusion = counts if self.confusion is None else self.confusion + counts
+        top5 = scores.topk(min(5, self.n_classes), 1).indices
+        self.top5_corrects += int((top5 == labels.unsqueeze(1)).any(1).sum())
+        return predictions
+
+    def matrix(self):
+        """
+        :return: Numpy array [classes, classes], rows are the real labels and columns the predictions.
+        """
+        if self.confusion is None:
+            return np.zeros((self.n_classes, self.n_classes), dtype=np.int64)
+        return self.confusion.view(self.n_classes, self.n_classes).numpy()
+
+    def metrics(self, class_names):
+        return classification_metrics(self.matrix(), class_names, self.top5_corrects)
+
+
+def metrics_paths(result_path):
+    """
+    :return: Paths of the confusion matrix csv and the metrics json written next to a result file of verify_model.
+    """
+    stem = os.path.splitext(result_path)[0]
+    return stem + '_cm.csv', stem + '_metrics.json'
+
+
+def write_metrics(result_path, confusion, metrics, class_names):
+    cm_path, json_path = metrics_paths(result_path)
+    pd.DataFrame(confusion, index=class_names, columns=class_names).to_csv(cm_path)
+    with open(json_path, 'w', encoding='utf-8') as f_json:
+        json.dump(metrics, f_json, indent=1)
+
+
+# Classify image and write the results into ./Results/
+def verify_model(model, test_loader, device, target, data_size, model_name, top_k=0, output_format='csv'):
     """
     Get the classified label of each image. Return a classification results csv file in the Results Directory.
+    Results are written batch by batch, so memory does not grow with the size of the test set. The confusion matrix
+    (<result>_cm.csv, rows are the real labels) and top-1, top-5 and per class precision, recall and F1
+    (<result>_metrics.json) are accumulated on the way and written next to the results.
     :param model: A pre-trained CNN model.
     :param test_loader: An instance of Data_loader class. Defines the source of image.
     :param device: Cpu or cuda.
     :param target: Species or genus.
     :param data_size: Size of the data, i.e. how many images.
+    :param top_k: Number of (class, probability) column pairs of the most probable classes added to every row.
+    :param output_format: csv, or parquet (needs pyarrow).
     :return: Accuracy of the classification, float.
     """
+    # Imported here, so the cm mode of test_entrance.py does not load torch
+    import torch
+
     since = time.time()
 
-    class_dict = extract_class_label(target)
-    running_corrects = 0
-    all_labels =[]
-    all_paths = []
-    all_predictions = []
-    with torch.no_grad():
-        # iterate over batch
-        for images, labels, paths in tqdm(test_loader):
-            all_paths.append(paths)
-            all_labels.append(labels)
-
-            images = images.to(device)
-            labels = labels.to(device)
-            outputs = model(images)
-            _, predictions = torch.max(outputs, 1)
-            all_predictions.append(predictions)
-            # collect the correct predictions for each class
-
-            running_corrects += torch.sum(predictions == labels.data)
-
-    # Horrible efficiency
-    outfile = './Results/' + str(int(since)) + '_' + target + '_' + model_name + '_result.csv'
-    all_predictions = all_predictions
-    with open(outfile, 'a', encoding='ascii', errors='ignore', newline='') as f_guide:
-        writer = csv.writer(f_guide)
-        for label_batch, prediction_batch, path_batch in zip(all_labels, all_predictions, all_paths):
-            for label, prediction, path in zip(label_batch, prediction_batch, path_batch):
-                row = [path]
-                label = int(label.numpy())
-                label_t = class_dict[label]
-                row.append(label_t)
-                prediction = int(prediction.cpu().data.numpy())
-                pred_t = class_dict[prediction]
-                row.append(pred_t)
-                writer.writerow(row)
-    f_guide.close()
-    accu = running_corrects.double() / data_size
+    # Indexed with a whole batch of labels at once
+    class_names = np.array(extract_class_label(target), dtype=object)
+    n_classes = len(class_names)
+    top_k = min(top_k, n_classes)
+    accumulator = MetricsAccumulator(n_classes)
+    extension = '.parquet' if output_format == 'parquet' else '.csv'
+    outfile = './Results/' + str(int(since)) + '_' + target + '_' + model_name + '_result' + extension
+    writer = ResultWriter(outfile, _result_columns(top_k), output_format)
+    try:
+        with torch.no_grad():
+            # iterate over batch
+            for images, labels, paths in tqdm(test_loader):
+                images = images.to(device)
+                outputs = model(images).cpu()
+                # One conversion per batch
+                predictions = accumulator.update(outputs, labels).numpy()
+                columns = [list(paths), class_names[labels.numpy()], class_names[predictions]]
+                if top_k > 0:
+                    probabilities, classes = torch.topk(torch.softmax(outputs.float(), 1), top_k)
+                    probabilities, classes = probabilities.cpu().numpy(), classes.cpu().numpy()
+                    for k in range(top_k):
+                        columns += [class_names[classes[:, k]], probabilities[:, k]]
+                writer.write(columns)
+    finally:
+        writer.close()
+
+    metrics = accumulator.metrics(class_names)
+    accu = metrics['top1']
     print('Current test Acc: {:4f}'.format(accu))
     acc4 = str(float("{0:.4f}".format(accu)))
-    new_out = './Results/' + str(int(since)) + '_' + target + '_' + model_name + acc4 + '_result.csv'
+    new_out = './Results/' + str(int(since)) + '_' + target + '_' + model_name + acc4 + '_result' + extension
     os.rename(outfile, new_out)
+    write_metrics(new_out, accumulator.matrix(), metrics, class_names)
+    print('Top-5 Acc: {:4f}, macro F1: {:4f}'.format(metrics['top5'], metrics['macro_f1']))
     return accu
 
 
+def verify_ensemble(models, test_loader, device, target, data_size, output_format='csv'):
+    """
+    Classify the test set with several models at once. Every batch is decoded once and run through all models, the
+    ensemble prediction averages their softmax probabilities.
+    Rows of the result file are [path, label, ensemble prediction, ensemble probability] followed by prediction and
+    probability of every model, so the cm mode shows the ensemble. The metrics json holds the ensemble metrics and,
+    under 'models', those of every model.
+    :param models: Dictionary of name: model (or exported artifact), all on device and in eval mode.
+    :return: Dictionary of name: top-1 accuracy, including 'ensemble'.
+    """
+    import torch
+
+    since = time.time()
+    class_names = np.array(extract_class_label(target), dtype=object)
+    n_classes = len(class_names)
+    names = list(models)
+    accumulators = {name: MetricsAccumulator(n_classes) for name in names + ['ensemble']}
+    columns = ['path', 'label', 'prediction', 'ensemble_probability']
+    for name in names:
+        columns += [name + '_prediction', name + '_probability']
+    extension = '.parquet' if output_format == 'parquet' else '.csv'
+    outfile = './Results/' + str(int(since)) + '_' + target + '_ensemble_result' + extension
+    writer = ResultWriter(outfile, columns, output_format)
+    try:
+        with torch.no_grad():
+            for images, labels, paths in tqdm(test_loader):
+                images = images.to(device)
+                model_columns = []
+                average = 0
+                for name in names:
+                    probabilities = torch.softmax(models[name](images).float().cpu(), 1)
+                    average = average + probabilities / len(names)
+                    predictions = accumulators[name].update(probabilities, labels)
+                    model_columns += [class_names[predictions.numpy()],
+                                      probabilities.gather(1, predictions.unsqueeze(1)).squeeze(1).numpy()]
+                predictions = accumulators['ensemble'].update(average, labels)
+                writer.write([list(paths), class_names[labels.numpy()], class_names[predictions.numpy()],
+                              average.gather(1, predictions.unsqueeze(1)).squeeze(1).numpy()] + model_columns)
+    finally:
+        writer.close()
+
+    metrics = accumulators['ensemble'].metrics(class_names)
+    metrics['models'] = {name: accumulators[name].metrics(class_names) for name in names}
+    for name in names + ['ensemble']:
+        result = metrics if name == 'ensemble' else metrics['models'][name]
+        print('{:<30} top-1 {:.4f} top-5 {:.4f} macro F1 {:.4f}'.format(name, result['top1'], result['top5'],
+                                                                         result['macro_f1']))
+    acc4 = str(float("{0:.4f}".format(metrics['top1'])))
+    new_out = './Results/' + str(int(since)) + '_' + target + '_ensemble' + acc4 + '_result' + extension
+    os.rename(outfile, new_out)
+    write_metrics(new_out, accumulators['ensemble'].matrix(), metrics, class_names)
+    return {name: (metrics if name == 'ensemble' else metrics['models'][name])['top1'] for name in names + ['ensemble']}
+
+
 def plot_prediction(test_file, target = 'species',show_plot = True):
     """
-    This function is visualizing confusion matrix of classification result.
+    This function is visualizing confusion matrix of classification result. Rows are the real labels.
     :param test_file: the file containing the classification result of tested model. It is expected to be a output from
-    verify_model function with format of [image_path, predicted_label, real_label].
+    verify_model function with format of [image_path, real_label, predicted_label].
+    The confusion matrix and metrics written by verify_model are used when they exist, older result files are parsed.
     :return: None
     """
-    pred = pd.read_csv(test_file, header=None)
-    y_pred, y_real = pred.iloc[:, 2], pred.iloc[:, 1]
-    accCount = 0
-    for y1, y2 in zip(y_pred, y_real):
-        if y1 == y2:
-            accCount += 1
-    print(accCount / len(y_pred))
-    classes = extract_class_label(target)
-    cm = confusion_matrix(y_pred, y_real)
-    df_cm = pd.DataFrame(cm, index=classes,
-                         columns=classes)
-    df_cm.to_csv(test_file.split('.csv')[0]+'_cm.csv')
+    cm_path, json_path = metrics_paths(test_file)
+    if os.path.exists(cm_path) and os.path.exists(json_path):
+        df_cm = pd.read_csv(cm_path, index_col=0)
+        with open(json_path, 'r', encoding='utf-8') as f_json:
+            metrics = json.load(f_json)
+        print('Top-1: {top1:.4f} Top-5: {top5:.4f} macro F1: {macro_f1:.4f}'.format(**metrics))
+    else:
+        if test_file.endswith('.parquet'):
+            pred = pd.read_parquet(test_file)
+        else:
+            pred = pd.read_csv(test_file, header=None)
+        y_pred, y_real = pred.iloc[:, 2], pred.iloc[:, 1]
+        print((y_pred == y_real).mean())
+        from sklearn.metrics import confusion_matrix
+        classes = extract_class_label(target)
+        cm = confusion_matrix(y_real, y_pred, labels=classes)
+        df_cm = pd.DataFrame(cm, index=classes,
+                             columns=classes)
+        df_cm.to_csv(cm_path)
     if show_plot == True:
+        # Plotting libraries are only imported when a plot is shown
+        from matplotlib import pyplot as plt
+        import seaborn as sn
         plt.figure()
         sn.heatmap(df_cm, annot=True)
         plt.show()
@@ -0,0 +1,346 @@
+import os
+import csv
+import json
+import hashlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torchvision import transforms
+from torchvision.transforms import functional as TF
+from PIL import Image
+from Distributed_helper import world_size
+
+''' Helpers for feeding images to the training and testing loops. '''
+''' Functions included:
+    1. A pre-decoded image cache. The deterministic Resize of data_transforms is done once and the resized images are
+       kept in one uint8 memory-mapped array per Metadata csv, so an epoch only runs the remaining transforms.
+    2. A DataLoader configuration layer (workers, prefetching, pinned memory, worker thread pinning), so image decoding
+       overlaps with compute instead of running on the training thread.
+    3. An array-backed annotation index. Paths and labels of a Metadata csv are kept in a few NumPy arrays instead of
+       a DataFrame, which makes per-item access cheap and keeps DataLoader workers small.
+    4. A progressive resizing transform. Training images are shrunk to a per-epoch size that is read from shared
+       memory, so the schedule advances without re-creating the persistent DataLoader workers.
+'''
+
+CACHE_DECODE_THREADS = 8
+# Annotation indexes already loaded by this process, keyed by (csv path, csv mtime, image directory, shared)
+_INDEX_CACHE = {}
+# Upper bound of DataLoader workers chosen by the auto mode
+AUTO_MAX_WORKERS = 16
+
+
+def split_resize(d_transforms):
+    """
+    Split a transforms.Compose into its leading Resize and the transforms applied after it. The remaining transforms
+    are rewritten to work on uint8 CHW tensors, i.e. ToTensor is replaced by ConvertImageDtype.
+    :param d_transforms: A transforms.Compose starting with a transforms.Resize.
+    :return: resize: The leading Resize. rest: transforms.Compose of the remaining transforms for cached images.
+    """
+    steps = list(d_transforms.transforms)
+    if len(steps) == 0 or not isinstance(steps[0], transforms.Resize):
+        raise ValueError('Image cache needs a transform starting with a Resize, got {}'.format(d_transforms))
+    resize = steps[0]
+    rest = []
+    for step in steps[1:]:
+        if isinstance(step, transforms.ToTensor):
+            rest.append(transforms.ConvertImageDtype(torch.float))
+        else:
+            rest.append(step)
+    return resize, transforms.Compose(rest)
+
+
+def parse_resize_schedule(text):
+    """
+    Parse a progressive resizing schedule given on the command line.
+    :param text: Comma separated size:epochs pairs, e.g. '128:3,176:3' trains 3 epochs at 128px, 3 epochs at 176px and
+    the remaining epochs at the full resolution of data_transforms.
+    :return: List of (size, epochs) tuples.
+    """
+    schedule = []
+    for item in text.split(','):
+        size, epochs = item.split(':')
+        if int(size) <= 0 or int(epochs) <= 0:
+            raise ValueError('Sizes and epochs of the resize schedule must be positive, got {}'.format(item))
+        schedule.append((int(size), int(epochs)))
+    return schedule
+
+
+class ProgressiveResize:
+    """
+    Transform resizing the (cropped) image to the size of the current epoch. The size lives in a shared memory tensor,
+    so persistent DataLoader workers pick up set_epoch of the training process without being re-created.
+    """
+    def __init__(self, schedule):
+        """
+        :param schedule: List of (size, epochs) tuples, see parse_resize_schedule. After the last entry images are
+        passed on unchanged.
+        """
+        self.schedule = list(schedule)
+        # 0 means full resolution
+        self.size = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    def size_for_epoch(self, epoch):
+        """
+        :param epoch: Epoch number, starting from 1 as in train_model.
+        :return: The square size of the epoch, 0 for full resolution.
+        """
+        end = 0
+        for size, epochs in self.schedule:
+            end += epochs
+            if epoch <= end:
+                return size
+        return 0
+
+    def set_epoch(self, epoch):
+        self.size[0] = self.size_for_epoch(epoch)
+        return int(self.size[0])
+
+    def __call__(self, image):
+        size = int(self.size[0])
+        if size <= 0:
+            return image
+        return TF.resize(image, [size, size])
+
+    def __repr__(self):
+        return '{}(schedule={})'.format(self.__class__.__name__, self.schedule)
+
+
+def with_progressive_resize(d_transforms, progressive):
+    """
+    Insert a ProgressiveResize into a transforms.Compose right before ToTensor, i.e. after the crop, so the smaller
+    image is what gets converted and normalized.
+    :return: A new transforms.Compose.
+    """
+    steps = list(d_transforms.transforms)
+    position = next((i for i, step in enumerate(steps) if isinstance(step, transforms.ToTensor)), len(steps))
+    return transforms.Compose(steps[:position] + [progressive] + steps[position:])
+
+
+def _resize_size(resize):
+    size = resize.size
+    if isinstance(size, int) or len(size) != 2:
+        raise ValueError('Image cache needs a fixed [height, width] Resize, got {}'.format(size))
+    return int(size[0]), int(size[1])
+
+
+class AnnotationIndex:
+    """
+    Image paths and labels of an annotation csv stored as NumPy arrays: one uint8 buffer holding all encoded paths,
+    an int64 offset array into it and an int64 label array.
+    A handful of arrays pickle quickly into DataLoader workers, and unlike a DataFrame or a list of str, reading them
+    in a forked worker does not touch per-row reference counts, so the pages stay shared instead of being copied.
+    """
+    def __init__(self, paths, labels, share_memory=False):
+        """
+        :param paths: List of image paths.
+        :param labels: List of integer labels, same length as paths.
+        :param share_memory: Move the arrays to shared memory, so workers started with spawn map them instead of
+        receiving a copy.
+        """
+        encoded = [path.encode('utf-8') for path in paths]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self._shared = None
+        if share_memory:
+            self.share_memory()
+
+    def share_memory(self):
+        """
+        Move the arrays into torch shared memory. The NumPy arrays become views of the shared tensors.
+        """
+        self._shared = [torch.from_numpy(np.array(array)).share_memory_()
+                        for array in (self.buffer, self.offsets, self.labels)]
+        self.buffer, self.offsets, self.labels = [tensor.numpy() for tensor in self._shared]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def path(self, idx):
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def label(self, idx):
+        return int(self.labels[idx])
+
+    def paths(self):
+        return [self.path(idx) for idx in range(len(self))]
+
+    def __getstate__(self):
+        # Shared indexes are pickled as tensors, torch multiprocessing then only sends the shared memory handles
+        if self._shared is None:
+            return self.__dict__.copy()
+        return {'_shared': self._shared}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared is not None:
+            self.buffer, self.offsets, self.labels = [tensor.numpy() for tensor in self._shared]
+
+
+def load_annotation_index(annotations_file, img_dir, share_memory=False):
+    """
+    Load the annotation csv (image path, label; no header) into an AnnotationIndex. Every csv is only parsed once per
+    process until it is modified.
+    :param annotations_file: The file containing image directory and labels.
+    :param img_dir: The directory containing target images, joined to the path of every row.
+    :param share_memory: Whether the index is moved to shared memory.
+    :return: An AnnotationIndex instance.
+    """
+    key = (os.path.abspath(annotations_file), os.stat(annotations_file).st_mtime_ns, img_dir, share_memory)
+    if key not in _INDEX_CACHE:
+        paths = []
+        labels = []
+        with open(annotations_file, 'r', encoding='utf-8', newline='') as f_in:
+            for row in csv.reader(f_in):
+                if row:
+                    paths.append(os.path.join(img_dir, row[0]))
+                    labels.append(int(row[1]))
+        _INDEX_CACHE[key] = AnnotationIndex(paths, labels, share_memory)
+    return _INDEX_CACHE[key]
+
+
+def _fingerprint(annotations_file, paths, size):
+    """
+    Fingerprint of everything the cached pixels depend on: the csv, the mtime of every image and the resize size.
+    """
+    digest = hashlib.sha1()
+    csv_stat = os.stat(annotations_file)
+    digest.update('{}:{}:{}'.format(os.path.abspath(annotations_file), csv_stat.st_mtime_ns,
+                                    csv_stat.st_size).encode())
+    digest.update('{}x{}'.format(*size).encode())
+    for path in paths:
+        digest.update('{}:{}'.format(path, os.stat(path).st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def _decode_resized(path, resize):
+    image = Image.open(path).convert('RGB')
+    return np.asarray(resize(image), dtype=np.uint8)
+
+
+class ImageCache:
+    """
+    Memory-mapped array of pre-resized images, one row per line of an annotation csv.
+    The array is opened lazily, so pickling the cache into DataLoader workers only sends the file path and every
+    worker reads zero-copy slices of the same page cache.
+    """
+    def __init__(self, array_path, length, size):
+        self.array_path = array_path
+        self.length = length
+        self.size = size
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            # Copy-on-write mapping: slices are writable views, nothing is ever written back to the cache file.
+            self._array = np.load(self.array_path, mmap_mode='c')
+        return self._array
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        """
+        :param idx: Index of image.
+        :return: uint8 tensor of shape (3, height, width) sharing memory with the cache file.
+        """
+        return torch.from_numpy(self.array[idx]).permute(2, 0, 1)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+
+def build_image_cache(annotations_file, img_dir, resize, cache_dir):
+    """
+    Return the image cache of an annotation csv, building it when missing or stale. The cache is rebuilt when the csv
+    or the mtime of any listed image changes.
+    :param annotations_file: The file containing image directory and labels.
+    :param img_dir: The directory containing target images.
+    :param resize: The transforms.Resize applied before caching.
+    :param cache_dir: Directory holding the cache files.
+    :return: An ImageCache instance.
+    """
+    size = _resize_size(resize)
+    paths = load_annotation_index(annotations_file, img_dir).paths()
+    fingerprint = _fingerprint(annotations_file, paths, size)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(annotations_file))[0] + '_{}x{}'.format(*size)
+    array_path = os.path.join(cache_dir, base_name + '.npy')
+    meta_path = os.path.join(cache_dir, base_name + '.json')
+
+    if os.path.exists(meta_path) and os.path.exists(array_path):
+        with open(meta_path, 'r') as f_meta:
+            meta = json.load(f_meta)
+        if meta.get('fingerprint') == fingerprint and meta.get('length') == len(paths):
+            return ImageCache(array_path, len(paths), size)
+
+    print('Building image cache for {} ({} images).'.format(annotations_file, len(paths)))
+    tmp_path = array_path + '.tmp'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths), size[0], size[1], 3))
+    with ThreadPoolExecutor(max_workers=CACHE_DECODE_THREADS) as pool:
+        for idx, pixels in enumerate(pool.map(lambda p: _decode_resized(p, resize), paths)):
+            array[idx] = pixels
+    array.flush()
+    del array
+    os.replace(tmp_path, array_path)
+    with open(meta_path, 'w') as f_meta:
+        json.dump({'annotations_file': os.path.abspath(annotations_file), 'fingerprint': fingerprint,
+                   'length': len(paths), 'size': list(size)}, f_meta)
+    return ImageCache(array_path, len(paths), size)
+
+
+def _available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def auto_num_workers():
+    """
+    Number of DataLoader workers used by the auto mode: half of the usable cores, the other half is left to the
+    intra-op threads of the training process. Under torch.distributed the cores are shared by all local workers.
+    """
+    return min(AUTO_MAX_WORKERS, max(1, len(_available_cpus()) // (2 * world_size())))
+
+
+def _init_loader_worker(worker_id, pin_threads=False):
+    # Decoding workers do not need intra-op parallelism, it only competes with the training threads
+    torch.set_num_threads(1)
+    if pin_threads and hasattr(os, 'sched_setaffinity'):
+        # Workers take cores from the end of the list, the training process keeps the first ones
+        cpus = _available_cpus()
+        os.sched_setaffinity(0, {cpus[-1 - worker_id % len(cpus)]})
+
+
+def loader_config(num_workers='auto', persistent_workers=True, prefetch_factor=2, pin_memory='auto',
+                  pin_threads=False):
+    """
+    Build the keyword arguments for torch.utils.data.DataLoader.
+    :param num_workers: Number of worker processes, or 'auto' to size it from the usable cores.
+    :param persistent_workers: Keep workers alive between epochs instead of re-forking them.
+    :param prefetch_factor: Batches loaded in advance by each worker.
+    :param pin_memory: 'auto', 'on' or 'off' (or a bool). Auto pins memory when cuda is available.
+    :param pin_threads: Pin every worker to a single core.
+    :return: Dictionary of DataLoader keyword arguments.
+    """
+    if num_workers == 'auto':
+        num_workers = auto_num_workers()
+    num_workers = int(num_workers)
+    if pin_memory == 'auto':
+        pin_memory = torch.cuda.is_available()
+    elif isinstance(pin_memory, str):
+        pin_memory = pin_memory.lower() == 'on'
+
+    kwargs = {'num_workers': num_workers, 'pin_memory': bool(pin_memory)}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = prefetch_factor
+        kwargs['worker_init_fn'] = partial(_init_loader_worker, pin_threads=pin_threads)
+    return kwargs
@@ -0,0 +1,369 @@
+import os
+import csv
+import json
+import sqlite3
+import argparse
+
+import pandas as pd
+
+''' SQLite catalog of the images, labels, splits and slide records kept in the csv files of the project. '''
+''' Functions included:
+    1. Creating the catalog with indexed columns: images (file, species, genus, institution, width, height), labels
+       and splits per target (species.csv, genus.csv, Metadata/{target}_{phase}.csv, the guides) and the records of
+       all_records.csv (core, slide, grid, genus, species).
+    2. Importing the existing csv files: input.csv, output.csv, Data_organized/*, {target}.csv, {target}_guide.csv,
+       Metadata/*.csv and all_records.csv. Every importer first clears what it imported before, so rows removed from
+       a csv also leave the catalog.
+    3. Indexed lookups returning DataFrames, instead of reading and filtering a whole csv.
+    4. Exporting the tables back to csv files in the formats the other scripts read.
+
+    python Dataset_catalog.py import --root .
+    python Dataset_catalog.py export --root ./exported
+'''
+
+CATALOG_PATH = 'catalog.sqlite'
+PHASES = ['train', 'val', 'test']
+# Institutions of the Data_organized/{institution}_species_csv files written by metadata_helper.image_by_source
+INSTITUTIONS = ['YPM', 'NHM']
+# Columns of all_records.csv used by the Utils scripts, the others are kept in the raw row only
+RECORD_COLUMNS = {'core': 0, 'slide': 1, 'grid': 2, 'genus': 8, 'species': 9}
+IMAGE_COLUMNS = ['species', 'genus', 'institution', 'width', 'height']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    file TEXT PRIMARY KEY,
+    species TEXT,
+    genus TEXT,
+    institution TEXT,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_species ON images (species);
+CREATE INDEX IF NOT EXISTS images_genus ON images (genus);
+CREATE INDEX IF NOT EXISTS images_institution ON images (institution);
+
+CREATE TABLE IF NOT EXISTS labels (
+    target TEXT NOT NULL,
+    file TEXT NOT NULL,
+    label INTEGER,
+    split TEXT,
+    -- Label in the split csv, differs from label when the split was made before {target}.csv was relabelled
+    split_label INTEGER,
+    -- 1 for the rows of {target}.csv, 0 for files only found in the Metadata splits
+    listed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (target, file)
+);
+CREATE INDEX IF NOT EXISTS labels_split ON labels (target, split);
+CREATE INDEX IF NOT EXISTS labels_label ON labels (target, label);
+
+CREATE TABLE IF NOT EXISTS guides (
+    target TEXT NOT NULL,
+    label INTEGER NOT NULL,
+    name TEXT,
+    PRIMARY KEY (target, label)
+);
+
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    core TEXT,
+    slide TEXT,
+    grid INTEGER,
+    genus TEXT,
+    species TEXT,
+    raw TEXT
+);
+CREATE INDEX IF NOT EXISTS records_grid ON records (core, slide, grid);
+CREATE INDEX IF NOT EXISTS records_genus ON records (genus);
+'''
+
+
+def connect(path=CATALOG_PATH):
+    """
+    Open the catalog, creating the tables and indexes if needed.
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _read_csv(path, header='infer'):
+    with open(path, 'r', encoding='ascii', errors='ignore') as f_in:
+        return pd.read_csv(f_in, header=header, dtype=str, keep_default_na=False)
+
+
+def _replace_image_columns(conn, columns, rows):
+    """
+    Set the given columns of images from one csv, clearing them first for the files no longer in it. Files without
+    any value left are removed.
+    :param columns: Column names of images owned by the csv, without file.
+    :param rows: Lists of [file, *values].
+    """
+    rows = [list(row) for row in rows]
+    with conn:
+        conn.execute('UPDATE images SET ' + ', '.join(column + ' = NULL' for column in columns))
+        conn.executemany('INSERT OR IGNORE INTO images (file) VALUES (?)', [row[:1] for row in rows])
+        assignments = ', '.join(column + ' = ?' for column in columns)
+        conn.executemany('UPDATE images SET ' + assignments + ' WHERE file = ?', [row[1:] + row[:1] for row in rows])
+        conn.execute('DELETE FROM images WHERE ' + ' AND '.join(column + ' IS NULL' for column in IMAGE_COLUMNS))
+    return len(rows)
+
+
+def import_input(conn, in_path='input.csv'):
+    """
+    Species of input.csv, the genus is the part of the species before the first _ like in metadata_helper.
+    """
+    df = _read_csv(in_path)
+    species = df.iloc[:, 1]
+    genus = species.str.split('_', n=1).str[0]
+    return _replace_image_columns(conn, ['species', 'genus'], zip(df.iloc[:, 0], species, genus))
+
+
+def import_sizes(conn, out_path='output.csv'):
+    """
+    Width and height of output.csv, see metadata_helper.get_all_size.
+    """
+    df = _read_csv(out_path)
+    return _replace_image_columns(conn, ['width', 'height'], zip(df['filename'], df['width'], df['height']))
+
+
+def import_institutions(conn, organized_dir='Data_organized/'):
+    """
+    Institution of the images from the Data_organized/{institution}_species_csv files.
+    """
+    rows = []
+    for institution in INSTITUTIONS:
+        path = os.path.join(organized_dir, institution + '_species_csv')
+        if os.path.exists(path):
+            rows += [(file, institution) for file in _read_csv(path, header=None)[0]]
+    return _replace_image_columns(conn, ['institution'], rows)
+
+
+def import_labels(conn, target, label_path, guide_path=None):
+    """
+    Replace the labels of a target with a headerless file,label csv like species.csv or ostracods_genus.csv, and its
+    guide with the name,label guide csv. The splits of files still listed are kept.
+    """
+    df = _read_csv(label_path, header=None)
+    with conn:
+        splits = conn.execute('SELECT file, split_label, split FROM labels WHERE target = ? AND split IS NOT NULL',
+                              (target,)).fetchall()
+        # Deleted and inserted again, so the rows follow the order of the csv
+        conn.execute('DELETE FROM labels WHERE target = ?', (target,))
+        conn.executemany('INSERT OR REPLACE INTO labels (target, file, label, listed) VALUES (?, ?, ?, 1)',
+                         ((target, file, label) for file, label in zip(df[0], df[1])))
+        # Files of the splits missing from the csv stay with the label of their split
+        conn.executemany('INSERT OR IGNORE INTO labels (target, file, label) VALUES (?, ?, ?)',
+                         ((target, file, label) for file, label, _ in splits))
+        conn.executemany('UPDATE labels SET split = ?, split_label = ? WHERE target = ? AND file = ?',
+                         ((split, label, target, file) for file, label, split in splits))
+        if guide_path is not None and os.path.exists(guide_path):
+            guide = _read_csv(guide_path, header=None)
+            conn.execute('DELETE FROM guides WHERE target = ?', (target,))
+            conn.executemany('INSERT OR REPLACE INTO guides (target, label, name) VALUES (?, ?, ?)',
+                             ((target, label, name) for name, label in zip(guide[0], guide[1])))
+    return len(df)
+
+
+def import_splits(conn, target, metadata_dir='./Metadata/'):
+    """
+    Replace the splits of a target with the files of Metadata/{target}_{phase}.csv. Labels of files listed in
+    {target}.csv are not changed.
+    """
+    phases = {}
+    for phase in PHASES:
+        path = os.path.join(metadata_dir, target + '_' + phase + '.csv')
+        if os.path.exists(path):
+            phases[phase] = _read_csv(path, header=None)
+    with conn:
+        conn.execute('UPDATE labels SET split = NULL, split_label = NULL WHERE target = ?', (target,))
+        conn.execute('DELETE FROM labels WHERE target = ? AND listed = 0', (target,))
+        for phase, df in phases.items():
+            conn.executemany('INSERT OR IGNORE INTO labels (target, file) VALUES (?, ?)',
+                             ((target, file) for file in df[0]))
+            conn.executemany('UPDATE labels SET split = ?, split_label = ? WHERE target = ? AND file = ?',
+                             ((phase, label, target, file) for file, label in zip(df[0], df[1])))
+            # The label of {target}.csv is kept, files missing from it take the label of their split
+            conn.executemany('UPDATE labels SET label = ? WHERE target = ? AND file = ? AND listed = 0',
+                             ((label, target, file) for file, label in zip(df[0], df[1])))
+    return sum(len(df) for df in phases.values())
+
+
+def import_records(conn, records_path='all_records.csv'):
+    """
+    Replace the records with the rows of the headerless all_records.csv. The whole row is kept for the export.
+    """
+    with open(records_path, 'r', encoding='ascii', errors='ignore', newline='') as f_in:
+        rows = [row for row in csv.reader(f_in) if row]
+    with conn:
+        conn.execute('DELETE FROM records')
+        conn.executemany('INSERT INTO records (core, slide, grid, genus, species, raw) VALUES (?, ?, ?, ?, ?, ?)',
+                         ([row[idx] if idx < len(row) else None for idx in RECORD_COLUMNS.values()] +
+                          [json.dumps(row)] for row in rows))
+    return len(rows)
+
+
+def import_all(conn, root='.'):
+    """
+    Import every csv of the project found under root.
+    """
+    def path(*parts):
+        return os.path.join(root, *parts)
+
+    if os.path.exists(path('input.csv')):
+        print('input.csv:', import_input(conn, path('input.csv')))
+    if os.path.exists(path('output.csv')):
+        print('output.csv:', import_sizes(conn, path('output.csv')))
+    print('Data_organized:', import_institutions(conn, path('Data_organized')))
+    targets = set()
+    for name in sorted(os.listdir(root)):
+        target, extension = os.path.splitext(name)
+        if extension == '.csv' and os.path.exists(path(target + '_guide.csv')):
+            print(name + ':', import_labels(conn, target, path(name), path(target + '_guide.csv')))
+            targets.add(target)
+    if os.path.isdir(path('Metadata')):
+        for name in sorted(os.listdir(path('Metadata'))):
+            target, _, phase = os.path.splitext(name)[0].rpartition('_')
+            if phase in PHASES:
+                targets.add(target)
+        for target in sorted(targets):
+            print('Metadata/' + target + ':', import_splits(conn, target, path('Metadata')))
+    if os.path.exists(path('all_records.csv')):
+        print('all_records.csv:', import_records(conn, path('all_records.csv')))
+
+
+def _where(conditions):
+    conditions = {column: value for column, value in conditions.items() if value is not None}
+    if not conditions:
+        return '', []
+    return ' WHERE ' + ' AND '.join(column + ' = ?' for column in conditions), list(conditions.values())
+
+
+def find_images(conn, species=None, genus=None, institution=None):
+    """
+    :return: DataFrame of the images matching all given columns, in import order.
+    """
+    where, params = _where({'species': species, 'genus': genus, 'institution': institution})
+    return pd.read_sql_query('SELECT * FROM images' + where + ' ORDER BY rowid', conn, params=params)
+
+
+def find_labels(conn, target, split=None, label=None):
+    """
+    :return: DataFrame of file, label, split, split_label and listed of a target, e.g. the rows of
+    Metadata/species_train.csv. label is the label of {target}.csv, split_label the one of the split csv. Files only
+    found in the splits (listed 0) have the label of their split.
+    """
+    where, params = _where({'target': target, 'split': split, 'label': label})
+    return pd.read_sql_query('SELECT file, label, split, split_label, listed FROM labels' + where + ' ORDER BY rowid',
+                             conn, params=params)
+
+
+def find_records(conn, core=None, slide=None, grid=None, genus=None):
+    """
+    :return: DataFrame of the all_records.csv rows matching all given columns.
+    """
+    where, params = _where({'core': core, 'slide': slide, 'grid': grid, 'genus': genus})
+    return pd.read_sql_query('SELECT id, core, slide, grid, genus, species FROM records' + where + ' ORDER BY id',
+                             conn, params=params)
+
+
+def guide(conn, target):
+    """
+    :return: Class names of a target by label, like the {target}_guide.txt files.
+    """
+    return [name for name, in conn.execute('SELECT name FROM guides WHERE target = ? ORDER BY label', (target,))]
+
+
+def _write_rows(path, rows, header=None, lineterminator='\r\n'):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='ascii', errors='ignore', newline='') as f_out:
+        writer = csv.writer(f_out, lineterminator=lineterminator)
+        if header is not None:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+
+def export_input(conn, in_path='input.csv'):
+    # main.py writes input.csv with pandas
+    _write_rows(in_path, conn.execute('SELECT file, species FROM images WHERE species IS NOT NULL ORDER BY rowid'),
+                ['filename', 'genus_species'], '\n')
+
+
+def export_sizes(conn, out_path='output.csv'):
+    _write_rows(out_path, conn.execute('SELECT file, species, width, height FROM images WHERE width IS NOT NULL '
+                                       'ORDER BY rowid'), ['filename', 'genus_species', 'width', 'height'])
+
+
+def export_institutions(conn, organized_dir='Data_organized/'):
+    for institution in INSTITUTIONS:
+        for level in ['species', 'genus']:
+            rows = conn.execute('SELECT file, ' + level + ' FROM images WHERE institution = ? ORDER BY rowid',
+                                (institution,)).fetchall()
+            if rows:
+                _write_rows(os.path.join(organized_dir, institution + '_' + level + '_csv'), rows, lineterminator='\n')
+
+
+def export_labels(conn, target, label_path, guide_path=None):
+    """
+    Write {target}.csv and its guide, nothing when the target was only imported from Metadata splits.
+    """
+    rows = conn.execute('SELECT file, label FROM labels WHERE target = ? AND listed = 1 ORDER BY rowid',
+                        (target,)).fetchall()
+    if rows:
+        _write_rows(label_path, rows)
+    guide_rows = conn.execute('SELECT name, label FROM guides WHERE target = ? ORDER BY label', (target,)).fetchall()
+    if guide_path is not None and guide_rows:
+        _write_rows(guide_path, guide_rows)
+
+
+def export_splits(conn, target, metadata_dir='./Metadata/'):
+    for phase in PHASES:
+        rows = conn.execute('SELECT file, split_label FROM labels WHERE target = ? AND split = ? ORDER BY rowid',
+                            (target, phase)).fetchall()
+        if rows:
+            _write_rows(os.path.join(metadata_dir, target + '_' + phase + '.csv'), rows)
+
+
+def export_records(conn, records_path='all_records.csv'):
+    # Error_handling.py writes all_records.csv with pandas
+    _write_rows(records_path, (json.loads(raw) for raw, in conn.execute('SELECT raw FROM records ORDER BY id')),
+                lineterminator='\n')
+
+
+def export_all(conn, root='.'):
+    """
+    Write every table back to the csv files of the project under root.
+    """
+    export_input(conn, os.path.join(root, 'input.csv'))
+    export_sizes(conn, os.path.join(root, 'output.csv'))
+    export_institutions(conn, os.path.join(root, 'Data_organized'))
+    targets = [target for target, in conn.execute('SELECT DISTINCT target FROM labels')]
+    for target in targets:
+        export_labels(conn, target, os.path.join(root, target + '.csv'), os.path.join(root, target + '_guide.csv'))
+        export_splits(conn, target, os.path.join(root, 'Metadata'))
+    if conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]:
+        export_records(conn, os.path.join(root, 'all_records.csv'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action",
+                        choices=['import', 'export'],
+                        help="Import the csv files under --root into the catalog, or export the catalog to them.")
+    parser.add_argument("--root",
+                        type=str,
+                        default='.',
+                        help="Directory of input.csv, output.csv, species.csv, Metadata/ etc.")
+    parser.add_argument("--catalog",
+                        type=str,
+                        default=CATALOG_PATH,
+                        help="SQLite file of the catalog.")
+    args = parser.parse_args()
+    catalog = connect(args.catalog)
+    if args.action == 'import':
+        import_all(catalog, args.root)
+    else:
+        export_all(catalog, args.root)
+    catalog.close()
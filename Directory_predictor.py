@@ -0,0 +1,130 @@
+import os
+import csv
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from Train import data_transforms
+from Classification_helper import extract_class_label
+
+''' Classifying every image under a directory, without a Metadata csv. '''
+''' Functions included:
+    1. Walking a directory tree with os.scandir, yielding image paths lazily in a stable order.
+    2. Decoding and transforming images on a thread pool with a bounded number of images in flight, so decoding
+       overlaps with the model and memory stays flat.
+    3. Writing predictions batch by batch to a headerless csv [path, prediction, probability, (class, probability) of
+       the next classes]. Files already in the output are skipped, so an interrupted run continues where it stopped.
+'''
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+DECODE_THREADS = 8
+# Images decoded ahead of the model
+PREFETCH = 256
+
+
+def scan_images(root):
+    """
+    Yield the paths of all images under root, directories in name order.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield entry.path
+        # Reversed, so the stack pops them in name order
+        stack.extend(reversed(subdirectories))
+
+
+def predicted_paths(output_path):
+    """
+    :return: Set of the paths already written to the output csv.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, 'r', encoding='utf-8', newline='') as f_in:
+        return {row[0] for row in csv.reader(f_in) if row}
+
+
+def _decode(path, transform):
+    try:
+        with Image.open(path) as image:
+            return transform(image.convert('RGB'))
+    except Exception as e:
+        print('Cannot read {}: {}'.format(path, e))
+        return None
+
+
+def prefetch_images(paths, transform, threads=DECODE_THREADS, prefetch=PREFETCH):
+    """
+    Decode images on a thread pool, at most prefetch of them ahead of the consumer.
+    :return: Generator of (path, tensor) in the order of paths. tensor is None for unreadable files.
+    """
+    with ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for path in paths:
+            pending.append((path, pool.submit(_decode, path, transform)))
+            if len(pending) >= prefetch:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def _batches(images, batch_size):
+    batch = []
+    for path, tensor in images:
+        if tensor is None:
+            continue
+        batch.append((path, tensor))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def predict_directory(model, image_dir, target, output_path, device=torch.device('cpu'), batch_size=32, top_k=1,
+                      threads=DECODE_THREADS, prefetch=PREFETCH):
+    """
+    Classify all images under image_dir and append the predictions to output_path.
+    :param model: Eval mode model or exported artifact, images in and logits out.
+    :param target: Species or genus, for the class names of {target}_guide.txt.
+    :param top_k: Number of (class, probability) pairs per row, the first one is the prediction.
+    :return: Number of images classified in this run.
+    """
+    class_names = np.array(extract_class_label(target), dtype=object)
+    top_k = max(1, min(top_k, len(class_names)))
+    done = predicted_paths(output_path)
+    if done:
+        print('Skipping {} images already in {}'.format(len(done), output_path))
+    paths = (path for path in scan_images(image_dir) if path not in done)
+    classified = 0
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output_path, 'a', encoding='utf-8', newline='') as f_out, torch.no_grad():
+        writer = csv.writer(f_out)
+        for batch in tqdm(_batches(prefetch_images(paths, data_transforms, threads, prefetch), batch_size)):
+            images = torch.stack([tensor for _, tensor in batch]).to(device)
+            probabilities, classes = torch.topk(torch.softmax(model(images).float(), 1), top_k)
+            probabilities, classes = probabilities.cpu().numpy(), classes.cpu().numpy()
+            columns = [[path for path, _ in batch]]
+            for k in range(top_k):
+                columns += [class_names[classes[:, k]], probabilities[:, k]]
+            writer.writerows(zip(*columns))
+            # Flushed per batch, a crash loses at most the current batch
+            f_out.flush()
+            classified += len(batch)
+    print('Classified {} images, predictions in {}'.format(classified, output_path))
+    return classified
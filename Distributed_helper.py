@@ -0,0 +1,90 @@
+import os
+import sys
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+''' Multi-process data-parallel training on cpu with torch.distributed and the gloo backend. '''
+''' Functions included:
+    1. Launching n worker processes on this machine, each one joining the same gloo process group.
+    2. Small helpers used by the training loop: rank checks, unwrapping DistributedDataParallel and summing statistics
+       over all workers.
+    The process group is set up from MASTER_ADDR and MASTER_PORT, so the same workers can later join from several
+    machines.
+'''
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    """
+    Wait for all workers. Does nothing when not distributed.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def unwrap_model(model):
+    """
+    Return the module inside DistributedDataParallel, so state dicts never carry the 'module.' prefix.
+    """
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+
+def all_reduce_sum(values):
+    """
+    Sum a list of numbers over all workers.
+    :param values: List of python numbers or scalar tensors.
+    :return: List of floats, the sums. Unchanged when not distributed.
+    """
+    if not is_distributed():
+        return [float(v) for v in values]
+    tensor = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, nproc, port, threads, fn, fn_args):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(port))
+    dist.init_process_group('gloo', rank=rank, world_size=nproc)
+    torch.set_num_threads(threads)
+    if rank != 0:
+        # Only the first worker reports progress
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        fn(rank, nproc, *fn_args)
+    finally:
+        dist.destroy_process_group()
+
+
+def run_distributed(nproc, fn, *fn_args):
+    """
+    Run fn(rank, nproc, *fn_args) in nproc processes joined into a gloo process group. The cpu cores are split evenly
+    between the processes.
+    :param nproc: Number of worker processes.
+    :param fn: Module level function executed by every worker.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    threads = max(1, cpus // nproc)
+    port = int(os.environ.get('MASTER_PORT', _free_port()))
+    print('Starting {} gloo workers with {} threads each.'.format(nproc, threads))
+    mp.spawn(_worker, args=(nproc, port, threads, fn, fn_args), nprocs=nproc, join=True)
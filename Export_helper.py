@@ -0,0 +1,195 @@
+import os
+import copy
+import time
+import inspect
+
+import torch
+import torch.fx
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from Train import load_data, data_transforms
+from Classification_helper import verify_model
+
+try:
+    import onnxruntime
+except ImportError:
+    # ONNX artifacts can be exported without it, but only TorchScript artifacts can be run
+    onnxruntime = None
+
+''' Exporting trained models for cpu inference. '''
+''' Functions included:
+    1. Folding every BatchNorm2d that directly follows a Conv2d into the convolution weights.
+    2. Exporting a checkpoint from ./Models/ to a frozen TorchScript (.pt) or an ONNX (.onnx) artifact.
+    3. Loading an artifact as a callable engine, ONNX artifacts run on ONNX Runtime.
+    4. Measuring images/sec of the eager model and the artifact on the same pre-loaded batches.
+'''
+
+ARTIFACT_EXTENSIONS = {'torchscript': '.pt', 'onnx': '.onnx'}
+# Batches of the test csv used for the throughput comparison
+BENCHMARK_BATCHES = 10
+
+
+def fuse_conv_bn(model):
+    """
+    Fold every BatchNorm2d whose only input is a Conv2d into that convolution. The model must be in eval mode.
+    :param model: A torch.nn.Module.
+    :return: A torch.fx.GraphModule without the folded BatchNorm2d layers. The model itself when it cannot be traced.
+    """
+    try:
+        traced = torch.fx.symbolic_trace(copy.deepcopy(model))
+    except Exception as e:
+        print('Conv+bn fusion skipped, the model cannot be traced: ' + str(e))
+        return model
+    modules = dict(traced.named_modules())
+    fused = 0
+    for node in list(traced.graph.nodes):
+        if node.op != 'call_module' or not isinstance(modules[node.target], torch.nn.BatchNorm2d):
+            continue
+        conv_node = node.args[0]
+        if not isinstance(conv_node, torch.fx.Node) or conv_node.op != 'call_module' or \
+                not isinstance(modules[conv_node.target], torch.nn.Conv2d) or len(conv_node.users) > 1:
+            continue
+        conv = fuse_conv_bn_eval(modules[conv_node.target], modules[node.target])
+        parent_name, _, name = conv_node.target.rpartition('.')
+        # Traced submodules are plain Modules, also where the original was a Sequential
+        setattr(traced.get_submodule(parent_name) if parent_name else traced, name, conv)
+        modules[conv_node.target] = conv
+        node.replace_all_uses_with(conv_node)
+        traced.graph.erase_node(node)
+        fused += 1
+    traced.graph.lint()
+    traced.recompile()
+    traced.delete_all_unused_submodules()
+    print('Fused {} conv+bn pairs.'.format(fused))
+    return traced
+
+
+def default_format():
+    return 'onnx' if onnxruntime is not None else 'torchscript'
+
+
+def export_model(model, artifact_path, fmt='torchscript', image_size=224):
+    """
+    Export an eval mode copy of the model with conv+bn fused.
+    :param model: Model with the trained weights loaded.
+    :param artifact_path: Output file.
+    :param fmt: torchscript or onnx.
+    :param image_size: Height and width of the example input, the batch size stays dynamic.
+    """
+    model = fuse_conv_bn(copy.deepcopy(model).to('cpu').eval())
+    example = torch.randn(1, 3, image_size, image_size)
+    directory = os.path.dirname(artifact_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if fmt == 'torchscript':
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(model, example).eval())
+        torch.jit.save(scripted, artifact_path)
+    elif fmt == 'onnx':
+        kwargs = {}
+        # Newer torch versions default to the dynamo exporter, which needs onnxscript
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            kwargs['dynamo'] = False
+        torch.onnx.export(model, example, artifact_path, input_names=['images'], output_names=['logits'],
+                          dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=13,
+                          do_constant_folding=True, **kwargs)
+    else:
+        raise ValueError('Unsupported export format: {}'.format(fmt))
+    print('Exported', artifact_path)
+
+
+class OnnxEngine:
+    """
+    Callable running an ONNX artifact on ONNX Runtime, taking and returning torch tensors like the eager model.
+    """
+    def __init__(self, artifact_path, threads=None):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(artifact_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images):
+        return torch.from_numpy(self.session.run(None, {self.input_name: images.cpu().numpy()})[0])
+
+    def eval(self):
+        return self
+
+
+def load_artifact(artifact_path):
+    """
+    :return: A callable engine for the artifact, images in and logits out, on cpu.
+    """
+    if artifact_path.endswith(ARTIFACT_EXTENSIONS['onnx']):
+        if onnxruntime is None:
+            raise ImportError('Running ONNX artifacts needs onnxruntime, install it or export with --export_format '
+                              'torchscript.')
+        return OnnxEngine(artifact_path)
+    return torch.jit.load(artifact_path, map_location='cpu').eval()
+
+
+def throughput(engine, batches):
+    """
+    :return: Images/sec of engine over the pre-loaded batches, after one warm-up batch.
+    """
+    with torch.no_grad():
+        engine(batches[0])
+        since = time.perf_counter()
+        for images in batches:
+            engine(images)
+        seconds = time.perf_counter() - since
+    return sum(len(images) for images in batches) / seconds
+
+
+def compare_engines(model, engine, loader, n_batches=BENCHMARK_BATCHES):
+    """
+    Print the images/sec of the eager model and the artifact and the largest difference of their outputs.
+    """
+    batches = []
+    for images, _, _ in loader:
+        batches.append(images)
+        if len(batches) == n_batches:
+            break
+    model = model.to('cpu').eval()
+    with torch.no_grad():
+        difference = (model(batches[0]) - engine(batches[0])).abs().max().item()
+    eager = throughput(model, batches)
+    exported = throughput(engine, batches)
+    print('Largest output difference to the eager model: {:.2e}'.format(difference))
+    print('eager: {:.1f} images/sec, artifact: {:.1f} images/sec, speedup {:.2f}x'.format(eager, exported,
+                                                                                        exported / eager))
+    return eager, exported
+
+
+def export_checkpoint(model, pre_trained_path, artifact_path, target, fmt=None, loader_kwargs=None):
+    """
+    Load a checkpoint into the model, export it and compare the eager and exported throughput on the test csv.
+    :param model: Model from determine_model matching the checkpoint.
+    :param pre_trained_path: State dict saved by entrance.py.
+    :param artifact_path: Output file, None for the checkpoint path with the extension of the format.
+    :param fmt: torchscript or onnx, None for onnx when onnxruntime is installed and torchscript otherwise.
+    :return: The artifact path.
+    """
+    fmt = fmt or default_format()
+    if artifact_path is None:
+        artifact_path = os.path.splitext(pre_trained_path)[0] + ARTIFACT_EXTENSIONS[fmt]
+    model.load_state_dict(torch.load(pre_trained_path, map_location='cpu'))
+    export_model(model, artifact_path, fmt)
+    if fmt == 'onnx' and onnxruntime is None:
+        print('onnxruntime is not installed, the throughput comparison is skipped.')
+        return artifact_path
+    test_data, _ = load_data('test', target, data_transforms, loader_kwargs=loader_kwargs)
+    compare_engines(model, load_artifact(artifact_path), test_data)
+    return artifact_path
+
+
+def test_artifact(artifact_path, target, model_name, mode, cache_dir=None, loader_kwargs=None, top_k=0,
+                  output_format='csv'):
+    """
+    Same as Train.test_model, running an exported artifact instead of the eager model.
+    """
+    engine = load_artifact(artifact_path)
+    test_data, data_size = load_data(mode, target, data_transforms, cache_dir=cache_dir, loader_kwargs=loader_kwargs)
+    since = time.time()
+    verify_model(engine, test_data, torch.device('cpu'), target, data_size, model_name, top_k, output_format)
+    print('{:.1f} images/sec including decoding'.format(data_size / (time.time() - since)))
@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from Data_helper import loader_config, load_annotation_index
+from Model_registry import head_path, get_submodule, set_submodule
+from Train import CustomImageDataset, train_model, data_transforms, DEFAULTWD
+
+''' Head-only fine-tuning on a frozen backbone. '''
+''' Functions included:
+    1. A feature cache. The backbone runs once over the train, val and test csv and the pooled features are kept in
+       memory-mapped float32 arrays, keyed by model name, backbone weights and transform.
+    2. Training only the head on the cached features with train_model, then putting the head back into the model.
+'''
+
+FEATURE_DIR = './Features/'
+
+
+def feature_cache_key(model_name, model, d_transforms):
+    """
+    Key of the cached features: model name, hash of the backbone weights (the head is excluded, it does not change
+    the features) and the transform.
+    """
+    head_prefix = '.'.join(head_path(model_name)) + '.'
+    digest = hashlib.sha1()
+    digest.update(model_name.lower().encode())
+    digest.update(repr(d_transforms).encode())
+    for name, tensor in model.state_dict().items():
+        if name.startswith(head_prefix):
+            continue
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return model_name.lower() + '_' + digest.hexdigest()[:16]
+
+
+class FeatureDataset(Dataset):
+    """
+    Cached backbone features of one csv. Items are (feature, label, path) like CustomImageDataset, so the feature
+    loaders can be passed to train_model directly.
+    """
+    def __init__(self, feature_path, annotations_file, img_dir=''):
+        self.feature_path = feature_path
+        self.img_labels = load_annotation_index(annotations_file, img_dir)
+        self._features = None
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = np.load(self.feature_path, mmap_mode='c')
+        return self._features
+
+    def __len__(self):
+        return len(self.img_labels)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.features[idx]), self.img_labels.label(idx), self.img_labels.path(idx)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+
+def extract_features(model, model_name, key, phase, target, device, batch_size=64, feature_dir=FEATURE_DIR,
+                     loader_kwargs=None):
+    """
+    Run the backbone once over Metadata/{target}_{phase}.csv and store the features. Reuses the stored features when
+    the key and the csv are unchanged.
+    :param model: Model from determine_model. The head is temporarily replaced by an identity.
+    :param model_name: Name of the model in the registry.
+    :param key: Key from feature_cache_key.
+    :return: A FeatureDataset.
+    """
+    data_path = './Metadata/' + target + '_' + phase + '.csv'
+    os.makedirs(feature_dir, exist_ok=True)
+    feature_path = os.path.join(feature_dir, key + '_' + target + '_' + phase + '.npy')
+    meta_path = os.path.join(feature_dir, key + '_' + target + '_' + phase + '.json')
+    csv_mtime = os.stat(data_path).st_mtime_ns
+
+    if os.path.exists(meta_path) and os.path.exists(feature_path):
+        with open(meta_path, 'r') as f_meta:
+            if json.load(f_meta).get('csv_mtime') == csv_mtime:
+                return FeatureDataset(feature_path, data_path)
+
+    print('Extracting {} features of {}.'.format(phase, key))
+    dataset = CustomImageDataset(data_path, '', data_transforms)
+    if len(dataset) == 0:
+        raise ValueError('{} has no images, nothing to extract features from.'.format(data_path))
+    if loader_kwargs is None:
+        loader_kwargs = loader_config()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+    path = head_path(model_name)
+    head = get_submodule(model, path)
+    set_submodule(model, path, torch.nn.Identity())
+    model.eval()
+    features = None
+    start = 0
+    try:
+        with torch.no_grad():
+            for inputs, _, _ in tqdm(loader):
+                outputs = model(inputs.to(device)).flatten(1).cpu().numpy()
+                if features is None:
+                    features = np.lib.format.open_memmap(feature_path + '.tmp', mode='w+', dtype=np.float32,
+                                                         shape=(len(dataset), outputs.shape[1]))
+                features[start:start + len(outputs)] = outputs
+                start += len(outputs)
+    finally:
+        set_submodule(model, path, head)
+    features.flush()
+    del features
+    os.replace(feature_path + '.tmp', feature_path)
+    with open(meta_path, 'w') as f_meta:
+        json.dump({'csv': os.path.abspath(data_path), 'csv_mtime': csv_mtime, 'length': len(dataset)}, f_meta)
+    return FeatureDataset(feature_path, data_path)
+
+
+def frozen_train(model, model_name, target, batch_size, n_epochs, criterion, optimizer, scheduler,
+                 feature_dir=FEATURE_DIR, loader_kwargs=None, **train_kwargs):
+    """
+    Train only the classification head of a model on cached backbone features.
+    :param model: Model from determine_model.
+    :param model_name: Name of the model, part of the feature cache key.
+    :param optimizer: Optimizer over the head parameters only, i.e. built from Model_registry.get_head.
+    :param train_kwargs: Further keyword arguments of train_model, e.g. tolerance or checkpoint_path.
+    :return: The model with the trained head and the path prefix for saving it, like single_train.
+    """
+    os.chdir(DEFAULTWD)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = model.to(device)
+    key = feature_cache_key(model_name, model, data_transforms)
+    feature_sets = {}
+    for phase in ['train', 'val', 'test']:
+        if phase == 'test' and not os.path.exists('./Metadata/' + target + '_test.csv'):
+            continue
+        feature_sets[phase] = extract_features(model, model_name, key, phase, target, device, feature_dir=feature_dir,
+                                               loader_kwargs=loader_kwargs)
+
+    # Features are small, reading them in the main process is faster than feeding them through workers
+    dataloaders = {phase: DataLoader(data, batch_size=batch_size, shuffle=True) for phase, data in
+                   feature_sets.items()}
+    dataset_sizes = {phase: len(data) for phase, data in feature_sets.items()}
+    path = head_path(model_name)
+    head, save_path = train_model(model=get_submodule(model, path), criterion=criterion, optimizer=optimizer,
+                                  scheduler=scheduler, num_epochs=n_epochs, dataloaders=dataloaders,
+                                  dataset_sizes=dataset_sizes, device=device, **train_kwargs)
+    set_submodule(model, path, head)
+
+    if 'test' in dataloaders:
+        head.eval()
+        corrects = 0
+        with torch.no_grad():
+            for inputs, labels, _ in dataloaders['test']:
+                corrects += int(torch.sum(torch.argmax(head(inputs.to(device)), 1) == labels.to(device)))
+        print('Test Acc: {:.4f}'.format(corrects / dataset_sizes['test']))
+    return model, save_path
@@ -0,0 +1,214 @@
+import os
+import sys
+import csv
+import time
+import random
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+''' Local hyper-parameter search with asynchronous successive halving. '''
+''' Functions included:
+    1. Sampling trial configurations from SEARCH_SPACE, the lr, batch_size, step_size, gamma and momentum space of the
+       former Ray Tune config in Calling_master.py.
+    2. Running the trials concurrently in a process pool on this machine. The cpu cores are split evenly between the
+       concurrent trials, every trial uses torch.set_num_threads with its share and loads data in its own process.
+    3. Asynchronous successive halving (ASHA). Rungs are at grace, grace*eta, grace*eta^2 ... epochs. A trial reaching a
+       rung continues only when its validation accuracy is in the top 1/eta of all trials that reached the rung so far,
+       otherwise train_model stops it through its epoch_callback.
+    4. A single leaderboard csv with the configuration and result of every trial, sorted by the best validation
+       accuracy and rewritten whenever a trial finishes.
+'''
+
+# name: (distribution, arguments)
+SEARCH_SPACE = {
+    'lr': ('loguniform', 1e-5, 1e-1),
+    'batch_size': ('choice', [16, 32, 64, 112]),
+    'step_size': ('randint', 3, 8),
+    'gamma': ('choice', [0.01, 0.05, 0.1, 0.2, 0.5]),
+    'momentum': ('choice', [0.5, 0.6, 0.7, 0.8, 0.9]),
+}
+
+LEADERBOARD_FIELDS = ['trial', 'status', 'best_val_acc', 'best_epoch', 'epochs', 'seconds'] + list(SEARCH_SPACE) + \
+                     ['model_path', 'log_path', 'error']
+
+
+def sample_config(rng, space=SEARCH_SPACE):
+    """
+    Draw one trial configuration.
+    :param rng: random.Random instance.
+    :param space: Dictionary of name: (distribution, arguments), distribution is loguniform, uniform, randint or
+    choice.
+    :return: Dictionary of name: value.
+    """
+    config = {}
+    for name, (kind, *params) in space.items():
+        if kind == 'loguniform':
+            config[name] = float(np.exp(rng.uniform(np.log(params[0]), np.log(params[1]))))
+        elif kind == 'uniform':
+            config[name] = rng.uniform(params[0], params[1])
+        elif kind == 'randint':
+            config[name] = rng.randint(params[0], params[1])
+        elif kind == 'choice':
+            config[name] = rng.choice(params[0])
+        else:
+            raise ValueError('Unknown distribution {} of {}'.format(kind, name))
+    return config
+
+
+def rungs(grace, eta, max_epochs):
+    """
+    :return: List of the epochs at which trials are compared, grace * eta^k below max_epochs.
+    """
+    milestones = []
+    epoch = grace
+    while epoch < max_epochs:
+        milestones.append(epoch)
+        epoch *= eta
+    return milestones
+
+
+class SuccessiveHalving:
+    """
+    epoch_callback of train_model for one trial. The validation accuracies reached at every rung are shared between
+    the trial processes through a Manager dictionary.
+    """
+    def __init__(self, rung_results, lock, grace, eta, max_epochs):
+        """
+        :param rung_results: Manager dictionary of epoch: list of validation accuracies.
+        :param lock: Manager lock guarding rung_results.
+        :param grace: Epochs every trial runs before it can be stopped.
+        :param eta: Reduction factor, only the top 1/eta of the trials continues at every rung.
+        """
+        self.rung_results = rung_results
+        self.lock = lock
+        self.eta = eta
+        self.milestones = set(rungs(grace, eta, max_epochs))
+        self.history = []
+        self.pruned = False
+
+    def __call__(self, epoch, val_acc, val_loss):
+        self.history.append((epoch, val_acc))
+        if epoch not in self.milestones:
+            return False
+        with self.lock:
+            # Manager dictionaries only see assignments, not in-place changes of the stored list
+            recorded = self.rung_results.get(epoch, []) + [val_acc]
+            self.rung_results[epoch] = recorded
+        # The first trials at a rung have nothing to be compared with
+        if len(recorded) < self.eta:
+            return False
+        cutoff = np.percentile(recorded, 100 * (1 - 1 / self.eta))
+        self.pruned = val_acc < cutoff
+        return self.pruned
+
+
+def run_trial(trial, config, args, threads, rung_results, lock, log_path):
+    """
+    Train one configuration in a pool process. Output of the trial goes to its log file.
+    :param trial: Number of the trial.
+    :param config: Configuration from sample_config.
+    :param args: Parsed arguments of entrance.py, the model, target, epochs and the other fixed settings.
+    :param threads: Number of cpu threads of this trial.
+    :return: Dictionary, the leaderboard row.
+    """
+    import torch
+    from Train import single_train
+    from Data_helper import loader_config, parse_resize_schedule
+    from Model_registry import determine_model
+    from entrance import determine_optimizer, determine_criterion, determine_scheduler
+
+    torch.set_num_threads(threads)
+    sys.stdout = sys.stderr = open(log_path, 'w', buffering=1)
+    since = time.time()
+    model = determine_model(args.model, args.pretrained, args.classes)
+    optimizer = determine_optimizer(model, args.optimizer, config['lr'], config['momentum'], args.lambd)
+    criterion = determine_criterion(args.criterion)
+    scheduler = determine_scheduler(optimizer, args.scheduler, config['step_size'], config['gamma'])
+    halving = SuccessiveHalving(rung_results, lock, args.search_grace, args.search_eta, args.epochs)
+    # The trials already use all cores between them, so batches are loaded in the trial process
+    model, save_path = single_train(model=model, target=args.target, batch_size=config['batch_size'],
+                                    n_epochs=args.epochs, criterion=criterion, optimizer=optimizer,
+                                    scheduler=scheduler, cache_dir=args.cache_dir,
+                                    loader_kwargs=loader_config(num_workers=0, persistent_workers=False),
+                                    precision=args.precision, memory_format=args.memory_format,
+                                    checkpoint_path=None, epoch_callback=halving,
+                                    resize_schedule=parse_resize_schedule(args.progressive_resize)
+                                    if args.progressive_resize else None)
+    best_epoch, best_acc = max(halving.history, key=lambda h: h[1])
+    row = dict(config, trial=trial, status='pruned' if halving.pruned else 'completed', best_val_acc=round(best_acc, 4),
+               best_epoch=best_epoch, epochs=len(halving.history), seconds=round(time.time() - since, 1),
+               log_path=log_path)
+    # Weights are only kept for the trials that were not pruned
+    if not halving.pruned:
+        row['model_path'] = save_path + '_' + args.target + '_' + args.model + '_trial' + str(trial) + '.pth'
+        torch.save(model.state_dict(), row['model_path'])
+    return row
+
+
+def write_leaderboard(path, rows):
+    rows = sorted(rows, key=lambda r: r.get('best_val_acc', -1), reverse=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f_out:
+        writer = csv.DictWriter(f_out, fieldnames=LEADERBOARD_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def search(args, n_trials, parallel=2, leaderboard_path=None):
+    """
+    Run n_trials sampled configurations, parallel of them at a time.
+    :param args: Parsed arguments of entrance.py. search_grace, search_eta and search_seed control the search.
+    :param n_trials: Number of trials.
+    :param parallel: Number of concurrent trials.
+    :param leaderboard_path: Output csv, default Results/<time>_<target>_<model>_search.csv.
+    :return: List of the leaderboard rows, best first.
+    """
+    prefix = str(int(time.time())) + '_' + args.target + '_' + args.model + '_search'
+    if leaderboard_path is None:
+        leaderboard_path = os.path.join('./Results/', prefix + '.csv')
+    log_dir = os.path.join(os.path.dirname(leaderboard_path) or '.', prefix + '_logs')
+    os.makedirs(log_dir, exist_ok=True)
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    threads = max(1, cpus // parallel)
+
+    if args.cache_dir is not None:
+        # Build the image caches once here, concurrent trials would otherwise all write them
+        from Train import data_transforms
+        from Data_helper import split_resize, build_image_cache
+        resize, _ = split_resize(data_transforms)
+        for phase in ['train', 'val']:
+            build_image_cache('./Metadata/' + args.target + '_' + phase + '.csv', '', resize, args.cache_dir)
+
+    rng = random.Random(args.search_seed)
+    configs = [sample_config(rng) for _ in range(n_trials)]
+    print('Searching {} trials, {} at a time with {} threads each. Rungs at epochs {}.'.format(
+        n_trials, parallel, threads, rungs(args.search_grace, args.search_eta, args.epochs)))
+    rows = []
+    manager = mp.Manager()
+    rung_results = manager.dict()
+    lock = manager.Lock()
+    # spawn, so the trials do not inherit the thread pools of this process
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=mp.get_context('spawn')) as pool:
+        futures = {}
+        for trial, config in enumerate(configs):
+            log_path = os.path.join(log_dir, 'trial{}.log'.format(trial))
+            future = pool.submit(run_trial, trial, config, args, threads, rung_results, lock, log_path)
+            futures[future] = (trial, config, log_path)
+        for future in as_completed(futures):
+            trial, config, log_path = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                row = dict(config, trial=trial, status='failed', log_path=log_path, error=str(e))
+            rows.append(row)
+            write_leaderboard(leaderboard_path, rows)
+            print('Trial {} {}: best val acc {} after {} epochs. {}'.format(
+                trial, row['status'], row.get('best_val_acc'), row.get('epochs'),
+                {k: config[k] for k in SEARCH_SPACE}))
+    manager.shutdown()
+    rows.sort(key=lambda r: r.get('best_val_acc', -1), reverse=True)
+    print('Leaderboard written to', leaderboard_path)
+    return rows
@@ -3,12 +3,22 @@ from PIL import Image
 import os
 from tqdm import tqdm
 import csv
- 
-# A list to store possible fault images
-fault = []
+import argparse
+from multiprocessing import Pool
+
+# Crops are written as TMP_PREFIX + name and renamed when complete
+TMP_PREFIX = '.tmp_'
+# Images sent to a worker at once
+CHUNKSIZE = 16
 
 # Find boundary of images
 def calculateBoundary(image, height, length):
+    """
+    Find the specimen on the dark background and cut off the white scale box below it.
+    Rows are searched along the middle column, the white box along column 9 and the left edge along one row. Each line
+    is summed over the channels at once and searched with numpy, the results are those of the former per pixel loops.
+    :return: top, bottom, left, right of the crop.
+    """
     startingPXL = [height // 4, length // 2]
     top = -1
     bottom = height - 1
@@ -17,48 +27,45 @@ def calculateBoundary(image, height, length):
     low_bound = -1
 
     # Create a vertical line, find white area and upper/lower boundary of image
-    for i in range(0, height):
-        if top == -1 and int(image[i][startingPXL[1]][0]) + int(image[i][startingPXL[1]][1]) + int(
-                image[i][startingPXL[1]][2]) > 6:
-            top = i
-        # Find white box
-        if low_bound == -1 and i >= 30 and int(image[i][9][0]) + int(image[i][9][1]) + int(image[i][9][2]) >= 751:
-            low_bound = i
-        if top != -1 and int(image[i][startingPXL[1]][0]) + int(image[i][startingPXL[1]][1]) + int(
-                image[i][startingPXL[1]][2]) <= 6:
-            if i - top > 60:
-                bottom = i
-                break
+    vertical = image[:height, startingPXL[1], :3].sum(axis=1, dtype=np.int64)
+    bright = np.flatnonzero(vertical > 6)
+    if bright.size:
+        top = int(bright[0])
+        # The first dark pixel more than 60 rows below the top ends the specimen
+        dark = np.flatnonzero(vertical[top + 61:] <= 6)
+        if dark.size:
+            bottom = top + 61 + int(dark[0])
+    # Find white box, above the bottom only as the row scan stopped there
+    white = np.flatnonzero(image[30:bottom + 1, 9, :3].sum(axis=1, dtype=np.int64) >= 751)
+    if white.size:
+        low_bound = 30 + int(white[0])
 
     if low_bound != -1 and low_bound >= top*2:
         startingPXL[0] = low_bound//2
 
-    for j in range(0, length):
-        if left == -1 and int(image[startingPXL[0]][j][0]) + int(image[startingPXL[0]][j][1]) + int(
-                image[startingPXL[0]][j][2]) > 6:
-            left = j
-            right = right-j
-            break
-        # if left != -1 and int(image[startingPXL[0]][j][0]) + int(image[startingPXL[0]][j][1]) + int(
-        #         image[startingPXL[0]][j][2]) <= 6:
-        #     if j - left > 60:
-        #         right = j
-        #         break
-    # print('Height: ', height, ' Width: ', length)
-    # print('Bottom: ', bottom, ' Bound: ', low_bound)
-    # print('Top: ', top, 'Left: ', left)
+    horizontal = image[startingPXL[0], :length, :3].sum(axis=1, dtype=np.int64)
+    bright = np.flatnonzero(horizontal > 6)
+    if bright.size:
+        left = int(bright[0])
+        right = right-left
+
     if bottom > low_bound != -1:
         bottom = low_bound
     if top == -1:
         top = 0
     if left == -1:
         left = 0
-    # print('Bottom: ', bottom, ' Bound: ', low_bound)
 
     return top, bottom, left, right
 
 
-def imageCorpping(im, name, trgDir, folder_name):
+def imageCorpping(im, name, trgDir, folder_name, src_mtime_ns=None):
+    """
+    Crop the specimen and save it as trgDir/name.
+    :param src_mtime_ns: Modification time of the source image, given to the crop so reruns can skip it.
+    :return: List of [name, folder, message] of possible faults.
+    """
+    fault = []
     na = np.array(im)
     orig = na.copy()  # Save original
 
@@ -78,38 +85,104 @@ def imageCorpping(im, name, trgDir, folder_name):
         fault.append([error,folder_name,error_msg])
     ROI = orig[top:bottom, left:right]
     finalDir = os.path.join(trgDir, name)
-    Image.fromarray(ROI).save(finalDir)
+    # Written under a temporary name first, an interrupted run never leaves a partial crop behind
+    tmpDir = os.path.join(trgDir, TMP_PREFIX + name)
+    Image.fromarray(ROI).save(tmpDir)
+    if src_mtime_ns is not None:
+        os.utime(tmpDir, ns=(src_mtime_ns, src_mtime_ns))
+    os.replace(tmpDir, finalDir)
+    return fault
+
+
+def crop_file(task):
+    """
+    Crop one image in a worker process.
+    :param task: (source path, name, target directory, folder name, source mtime in ns).
+    :return: List of fault rows, unreadable images are reported as a fault.
+    """
+    path, name, trgDir, folder_name, mtime_ns = task
+    try:
+        with Image.open(path) as img:
+            return imageCorpping(img.convert('RGB'), name, trgDir, folder_name, mtime_ns)
+    except Exception as e:
+        return [[name, folder_name, 'Corpping error: {}'.format(e)]]
 
 
-def load_images_from_folder(dir):
+def crop_tasks(dir, trgDir, force=False):
+    """
+    List the images of dir/*/images whose crop is missing or was made from an older source.
+    :return: (tasks for crop_file, number of skipped images)
+    """
+    tasks = []
+    skipped = 0
+    with os.scandir(dir) as folders:
+        folders = sorted(entry.name for entry in folders if entry.is_dir() and not entry.name.startswith('.'))
+    for foldername in folders:
+        finalFolder = os.path.join(dir, foldername, 'images')
+        if not os.path.isdir(finalFolder):
+            continue
+        with os.scandir(finalFolder) as files:
+            for entry in sorted(files, key=lambda e: e.name):
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                mtime_ns = entry.stat().st_mtime_ns
+                try:
+                    done = not force and os.stat(os.path.join(trgDir, entry.name)).st_mtime_ns == mtime_ns
+                except FileNotFoundError:
+                    done = False
+                if done:
+                    skipped += 1
+                else:
+                    tasks.append((entry.path, entry.name, trgDir, foldername, mtime_ns))
+    return tasks, skipped
+
+
+def load_images_from_folder(dir, trgDir, error_log='error_log.csv', workers=None, force=False):
+    """
+    Crop every image of dir/*/images into trgDir on a process pool. Crops carry the mtime of their source, images
+    with an up to date crop are skipped, so an interrupted run is continued by running it again. Faults are appended
+    to error_log as they are found.
+    :param force: Crop all images again and start a new error log.
+    :return: Number of fault rows written.
+    """
     print('Loading Files.')
-    for foldername in tqdm(os.listdir(dir)):
-        if not foldername.startswith('.'):
-            finalFolder = os.path.join(os.path.join(dir, foldername), 'images')
-            for filename in os.listdir(finalFolder):
-                img = Image.open(os.path.join(finalFolder, filename)).convert('RGB')
-                if img is not None:
-                #     images.append(img)
-                #     names.append(filename)
-                    imageCorpping(img, filename, trgDir, foldername)
-
-
-srcDir = './Data'
-trgDir = './Plaindata'
-load_images_from_folder(srcDir)
-print('Loading Finished.')
-cnt = 0
-print('Possible error images:')
-print(fault)
-
-with open('error_log.csv', 'w', encoding='ascii', errors='ignore', newline='') as f_guide:
-    writer = csv.writer(f_guide)
-    for error in fault:
-        row = error
-        writer.writerow(row)
-f_guide.close()
-
-# testIMG = './Image_test/730580_ex307653_obj00317.jpg'
-# name = testIMG.split('/')[-1]
-# im = Image.open(testIMG).convert('RGB')
-# imageCorpping(im,name,'')
\ No newline at end of file
+    os.makedirs(trgDir, exist_ok=True)
+    tasks, skipped = crop_tasks(dir, trgDir, force)
+    print('{} images to crop, {} already cropped.'.format(len(tasks), skipped))
+    faults = 0
+    with open(error_log, 'w' if force else 'a', encoding='ascii', errors='ignore', newline='') as f_guide, \
+            Pool(workers or os.cpu_count()) as pool:
+        writer = csv.writer(f_guide)
+        for rows in tqdm(pool.imap_unordered(crop_file, tasks, chunksize=CHUNKSIZE), total=len(tasks)):
+            if rows:
+                writer.writerows(rows)
+                f_guide.flush()
+                faults += len(rows)
+    return faults
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src",
+                        type=str,
+                        default='./Data',
+                        help="Raw data, images in <src>/<Genus-species>/images.")
+    parser.add_argument("--trg",
+                        type=str,
+                        default='./Plaindata',
+                        help="Folder of the cropped images.")
+    parser.add_argument("--error_log",
+                        type=str,
+                        default='error_log.csv',
+                        help="Csv of possible error images, appended to by every run.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="Worker processes, default all cpus.")
+    parser.add_argument("--force",
+                        action='store_true',
+                        help="Crop images with an up to date crop again and overwrite the error log.")
+    args = parser.parse_args()
+    faults = load_images_from_folder(args.src, args.trg, args.error_log, args.workers, args.force)
+    print('Loading Finished.')
+    print('{} possible error images, see {}'.format(faults, args.error_log))
@@ -0,0 +1,221 @@
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import torch
+from PIL import Image
+
+from Model_registry import determine_model
+from Train import data_transforms
+from Classification_helper import extract_class_label
+
+"""
+Resident inference server for the annotation tools. Models are loaded once and concurrent single image requests are
+collected into micro-batches, so interactive classification does not pay for imports and model loading every time.
+
+    python Inference_server.py --serve resnet152:Models/xxx_species_resnet152.pth:species --port 8765
+
+    curl --data-binary @crop.jpg "http://127.0.0.1:8765/classify?model=resnet152_species&topk=5"
+    curl http://127.0.0.1:8765/models
+
+POST /classify takes the raw image bytes (any format PIL reads), or a JSON body {"path": "<image file>"}. The answer is
+a JSON object with the top-k class names of the {target}_guide.txt file and their probabilities.
+"""
+
+MAX_BATCH = 32
+# Longest time the first request of a batch waits for more requests
+MAX_LATENCY_MS = 10
+
+
+class MicroBatcher:
+    """
+    Runs a model on a background thread over batches of the queued requests. A batch is started when MAX_BATCH
+    requests are waiting or the oldest one has waited max_latency_ms.
+    """
+    def __init__(self, model, class_names, max_batch=MAX_BATCH, max_latency_ms=MAX_LATENCY_MS):
+        """
+        :param model: Callable from images to logits, an eval mode model or an exported artifact.
+        :param class_names: Class names by label, from the guide file.
+        """
+        self.model = model
+        self.class_names = class_names
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """
+        :param image: Transformed image tensor, CHW.
+        :return: concurrent.futures.Future of the class probabilities.
+        """
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with torch.no_grad():
+                    probabilities = torch.softmax(self.model(torch.stack([image for image, _ in batch])).float(), 1)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), row in zip(batch, probabilities):
+                future.set_result(row)
+
+    def top_k(self, probabilities, k):
+        values, labels = torch.topk(probabilities, min(k, len(probabilities)))
+        return [{'class': self.class_names[label], 'label': int(label), 'probability': round(float(value), 6)}
+                for value, label in zip(values, labels)]
+
+
+def load_served_model(spec):
+    """
+    Load one model of --serve.
+    :param spec: [name=]model:path:target, e.g. resnet152:Models/xxx.pth:species. path is a state dict saved by
+    entrance.py, or a .pt/.onnx artifact of test_entrance.py --mode export/quantize. It may contain colons, like
+    Windows drive letters.
+    :return: (name, model, class names). The name defaults to model_target.
+    """
+    name, _, spec = spec.rpartition('=')
+    model_name, rest = spec.split(':', 1)
+    path, target = rest.rsplit(':', 1)
+    class_names = extract_class_label(target)
+    if path.endswith('.pth'):
+        model = determine_model(model_name, False, len(class_names))
+        model.load_state_dict(torch.load(path, map_location='cpu'))
+        model.eval()
+    else:
+        from Export_helper import load_artifact
+        model = load_artifact(path)
+    return name or model_name + '_' + target, model, class_names
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # Set by serve()
+    batchers = {}
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/models':
+            self._reply(200, {'models': sorted(self.batchers)})
+        else:
+            self._reply(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        since = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != '/classify':
+            self._reply(404, {'error': 'unknown path'})
+            return
+        query = parse_qs(url.query)
+        name = query.get('model', [next(iter(self.batchers))])[0]
+        if name not in self.batchers:
+            self._reply(404, {'error': 'unknown model {}'.format(name), 'models': sorted(self.batchers)})
+            return
+        try:
+            k = int(query.get('topk', ['5'])[0])
+            if k < 1:
+                raise ValueError('topk must be at least 1')
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                image = Image.open(json.loads(body)['path'])
+            else:
+                image = Image.open(io.BytesIO(body))
+            # Decoding and the transforms run on the request thread, only the model call is batched
+            tensor = data_transforms(image.convert('RGB'))
+        except Exception as e:
+            self._reply(400, {'error': 'bad request: {}'.format(e)})
+            return
+        batcher = self.batchers[name]
+        try:
+            probabilities = batcher.submit(tensor).result()
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {'model': name, 'predictions': batcher.top_k(probabilities, k),
+                          'latency_ms': round(1000 * (time.perf_counter() - since), 2)})
+
+    def log_message(self, format, *args):
+        # One line per request is too much for interactive use
+        pass
+
+
+def serve(specs, host='127.0.0.1', port=8765, max_batch=MAX_BATCH, max_latency_ms=MAX_LATENCY_MS):
+    """
+    Load the models and serve them until interrupted.
+    :param specs: List of model:path:target, see load_served_model.
+    """
+    batchers = {}
+    for spec in specs:
+        name, model, class_names = load_served_model(spec)
+        if name in batchers:
+            raise ValueError('Model name {} is used twice, name them with name=model:path:target.'.format(name))
+        batchers[name] = MicroBatcher(model, class_names, max_batch, max_latency_ms)
+        print('Loaded', name)
+    InferenceHandler.batchers = batchers
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    print('Serving on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve",
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help="Models to serve as [name=]model:path:target, e.g. resnet152:Models/xxx.pth:species.")
+    parser.add_argument("--host",
+                        type=str,
+                        default='127.0.0.1',
+                        help="Address to listen on, localhost only by default.")
+    parser.add_argument("--port",
+                        type=int,
+                        default=8765,
+                        help="Port to listen on.")
+    parser.add_argument("--max_batch",
+                        type=int,
+                        default=MAX_BATCH,
+                        help="Largest micro-batch.")
+    parser.add_argument("--max_latency_ms",
+                        type=float,
+                        default=MAX_LATENCY_MS,
+                        help="Longest time a request waits for others to join its batch.")
+    args = parser.parse_args()
+    serve(args.serve, args.host, args.port, args.max_batch, args.max_latency_ms)
@@ -0,0 +1,93 @@
+''' Registry of the classification models shared by entrance.py, test_entrance.py and the benchmarks. '''
+''' Every entry maps a model name to the torchvision constructor and the attribute path of its classification head,
+    which is replaced by a Linear layer with the requested number of classes. torch and torchvision are only imported
+    when a model is built, so listing or checking model names is instant.
+'''
+
+# name: (torchvision constructor, attribute path of the classification head)
+MODEL_REGISTRY = {
+    'resnet18': ('resnet18', 'fc'),
+    'resnet34': ('resnet34', 'fc'),
+    'resnet50': ('resnet50', 'fc'),
+    'resnet101': ('resnet101', 'fc'),
+    'resnet152': ('resnet152', 'fc'),
+    'vgg16': ('vgg16', 'classifier.6'),
+    'vgg19': ('vgg19', 'classifier.6'),
+    'efficientnet': ('efficientnet_b4', 'classifier.1'),
+    'convnext_tiny': ('convnext_tiny', 'classifier.2'),
+    'convnext_large': ('convnext_large', 'classifier.2'),
+    'regnet_y_16gf': ('regnet_y_16gf', 'fc'),
+    'vit_b_16': ('vit_b_16', 'heads.head'),
+    'efficient_v2': ('efficientnet_v2_l', 'classifier.1'),
+}
+
+# Model used for unknown names
+DEFAULT_MODEL = 'resnet50'
+# Unknown names already reported by resolve_name
+_UNKNOWN_WARNED = set()
+
+
+def model_names():
+    return list(MODEL_REGISTRY.keys())
+
+
+def resolve_name(arg_model):
+    """
+    Registry name of a model name given on the command line. Unknown names fall back to DEFAULT_MODEL.
+    """
+    name = arg_model.lower()
+    if name in MODEL_REGISTRY:
+        return name
+    # Warned once per name, the registry is looked up several times for one model
+    if name not in _UNKNOWN_WARNED:
+        _UNKNOWN_WARNED.add(name)
+        print('Unknown model {}, using {}.'.format(arg_model, DEFAULT_MODEL))
+    return DEFAULT_MODEL
+
+
+def head_path(arg_model):
+    """
+    :return: List of attribute names leading to the classification head, e.g. ['classifier', '6'].
+    """
+    return MODEL_REGISTRY[resolve_name(arg_model)][1].split('.')
+
+
+def get_submodule(model, path):
+    module = model
+    for name in path:
+        module = module[int(name)] if name.isdigit() else getattr(module, name)
+    return module
+
+
+def set_submodule(model, path, module):
+    parent = get_submodule(model, path[:-1])
+    if path[-1].isdigit():
+        parent[int(path[-1])] = module
+    else:
+        setattr(parent, path[-1], module)
+
+
+def get_head(model, arg_model):
+    """
+    :return: The classification head of a model built by determine_model.
+    """
+    return get_submodule(model, head_path(arg_model))
+
+
+def determine_model(arg_model, arg_pretrain, arg_classes):
+    """
+    Build a torchvision model with its classification head replaced for arg_classes classes.
+    :param arg_model: Model name, see MODEL_REGISTRY.
+    :param arg_pretrain: Load the ImageNet weights.
+    :param arg_classes: The count of classes for classification.
+    :return: The model.
+    """
+    import torch
+    from torchvision import models
+
+    constructor, _ = MODEL_REGISTRY[resolve_name(arg_model)]
+    model = getattr(models, constructor)(pretrained=arg_pretrain)
+    path = head_path(arg_model)
+    head = get_submodule(model, path)
+    set_submodule(model, path, torch.nn.Linear(head.in_features, arg_classes))
+    return model
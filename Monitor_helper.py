@@ -0,0 +1,109 @@
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None
+
+''' Throughput instrumentation of the training loop. '''
+''' For every epoch and phase the monitor records images/sec, the time blocked waiting for the DataLoader, the time
+    spent in forward (including the loss), backward and the optimizer step, and the peak resident memory. A run is I/O
+    bound when the data wait dominates and compute bound when forward and backward do.
+    Records are appended to a JSONL file as soon as a phase finishes and summarised as a table at the end of training.
+'''
+
+SECTIONS = ['data_wait', 'forward', 'backward', 'optimizer']
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, None when unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+class TrainingMonitor:
+    """
+    Collects per phase timings of train_model.
+    """
+    def __init__(self, log_path=None, device=None):
+        """
+        :param log_path: JSONL file the phase records are appended to. None keeps them in memory only.
+        :param device: Device of the model. On cuda the timed sections synchronize, so kernel time is not attributed
+        to the next section.
+        """
+        self.log_path = log_path
+        self.sync = device is not None and torch.device(device).type == 'cuda'
+        self.records = []
+        self._current = None
+
+    def start_phase(self, epoch, phase):
+        self._current = {'epoch': epoch, 'phase': phase, 'start': time.perf_counter()}
+        for section in SECTIONS:
+            self._current[section] = 0.0
+
+    def iterate(self, loader):
+        """
+        Iterate over a DataLoader, accumulating the time blocked in waiting for the next batch.
+        """
+        iterator = iter(loader)
+        while True:
+            since = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._current['data_wait'] += time.perf_counter() - since
+            yield batch
+
+    @contextmanager
+    def time(self, section):
+        since = time.perf_counter()
+        yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self._current[section] += time.perf_counter() - since
+
+    def end_phase(self, images):
+        """
+        Finish the current phase and write its record.
+        :param images: Number of images processed in the phase.
+        :return: Dictionary, the record.
+        """
+        seconds = time.perf_counter() - self._current.pop('start')
+        record = self._current
+        record['images'] = int(images)
+        record['seconds'] = round(seconds, 3)
+        record['images_per_sec'] = round(images / seconds, 2) if seconds > 0 else 0.0
+        for section in SECTIONS:
+            record[section] = round(record[section], 3)
+        record['peak_rss_mb'] = peak_rss_mb()
+        self.records.append(record)
+        self._current = None
+        if self.log_path is not None:
+            with open(self.log_path, 'a', encoding='ascii') as f_log:
+                f_log.write(json.dumps(record) + '\n')
+        return record
+
+    def summary(self):
+        """
+        Print a table of all recorded phases. Sections are shown as share of the phase wall time.
+        """
+        print('{:>5} {:>5} {:>8} {:>9} {:>6} {:>6} {:>6} {:>6} {:>9}'.format(
+            'epoch', 'phase', 'images', 'img/s', 'wait%', 'fwd%', 'bwd%', 'opt%', 'rss(MB)'))
+        for r in self.records:
+            share = [100 * r[section] / r['seconds'] if r['seconds'] > 0 else 0.0 for section in SECTIONS]
+            print('{:>5} {:>5} {:>8} {:>9.1f} {:>6.1f} {:>6.1f} {:>6.1f} {:>6.1f} {:>9}'.format(
+                r['epoch'], r['phase'], r['images'], r['images_per_sec'], *share, str(r['peak_rss_mb'])))
+        if self.log_path is not None:
+            print('Throughput records written to', self.log_path)
@@ -0,0 +1,127 @@
+import os
+import copy
+import time
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from Train import CustomImageDataset, load_data, data_transforms
+from Classification_helper import verify_model
+
+try:
+    from torch.ao import quantization as tq
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:
+    # torch < 1.10
+    from torch import quantization as tq
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+''' Post-training int8 quantization for cpu inference. '''
+''' Functions included:
+    1. Dynamic quantization: the weights of the Linear layers (the classification heads, and most of vgg) are stored
+       in int8 and activations are quantized on the fly.
+    2. Static quantization: convolutions and linear layers run in int8 with activation ranges observed during a
+       calibration pass over the first images of Metadata/{target}_val.csv (FX graph mode, so no model changes).
+    3. Comparing accuracy and images/sec of the fp32 and the quantized model with verify_model, and saving the
+       quantized model as TorchScript, which test_entrance.py loads with --artifact_path.
+'''
+
+QUANTIZATIONS = ['dynamic', 'static']
+# Images of the val csv observed by the static calibration
+CALIBRATION_IMAGES = 256
+
+
+def quantized_engine():
+    """
+    Select the best available int8 kernel backend, x86/fbgemm on intel and amd, qnnpack on arm.
+    """
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError('This torch build has no quantized cpu backend.')
+
+
+def quantize_dynamic(model):
+    return tq.quantize_dynamic(copy.deepcopy(model).to('cpu').eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def calibration_loader(target, n_images=CALIBRATION_IMAGES, batch_size=32):
+    """
+    DataLoader over the first n_images of the val csv.
+    """
+    dataset = CustomImageDataset('./Metadata/' + target + '_val.csv', '', data_transforms)
+    return DataLoader(Subset(dataset, range(min(n_images, len(dataset)))), batch_size=batch_size, shuffle=False)
+
+
+def quantize_static(model, calibration_data, image_size=224):
+    """
+    Post-training static quantization in FX graph mode.
+    :param model: fp32 model with the trained weights.
+    :param calibration_data: DataLoader of calibration images, see calibration_loader.
+    :return: The int8 model.
+    """
+    engine = quantized_engine()
+    model = copy.deepcopy(model).to('cpu').eval()
+    example = (torch.randn(1, 3, image_size, image_size),)
+    if hasattr(tq, 'get_default_qconfig_mapping'):
+        prepared = prepare_fx(model, tq.get_default_qconfig_mapping(engine), example)
+    else:
+        # torch < 1.13 takes a qconfig dictionary
+        prepared = prepare_fx(model, {'': tq.get_default_qconfig(engine)})
+    with torch.no_grad():
+        for images, _, _ in calibration_data:
+            prepared(images)
+    return convert_fx(prepared)
+
+
+def save_quantized(model, path, image_size=224):
+    """
+    Save the quantized model as TorchScript. Quantized modules cannot be loaded into a fresh fp32 model from a state
+    dict, so the artifact carries the graph as well.
+    """
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(model, torch.randn(1, 3, image_size, image_size)).eval())
+    torch.jit.save(scripted, path)
+    print('Quantized model saved to', path)
+
+
+def _timed_verify(model, test_data, data_size, target, model_name):
+    since = time.time()
+    accuracy = float(verify_model(model, test_data, torch.device('cpu'), target, data_size, model_name))
+    return accuracy, data_size / (time.time() - since)
+
+
+def quantize_checkpoint(model, pre_trained_path, target, model_name, method='static', mode='test',
+                        n_calibration=CALIBRATION_IMAGES, quantized_path=None, loader_kwargs=None):
+    """
+    Quantize a checkpoint of ./Models/, compare it with the fp32 model through verify_model and save it.
+    :param model: Model from determine_model matching the checkpoint.
+    :param pre_trained_path: State dict saved by entrance.py.
+    :param method: dynamic or static.
+    :param mode: Csv of the comparison, test or val.
+    :param n_calibration: Val images observed by static quantization.
+    :param quantized_path: Output file, default the checkpoint path with _int8_<method>.pt.
+    :return: The path of the saved model.
+    """
+    quantized_engine()
+    model.load_state_dict(torch.load(pre_trained_path, map_location='cpu'))
+    model = model.to('cpu').eval()
+    if method == 'dynamic':
+        quantized = quantize_dynamic(model)
+    elif method == 'static':
+        quantized = quantize_static(model, calibration_loader(target, n_calibration))
+    else:
+        raise ValueError('Unsupported quantization: {}'.format(method))
+    if quantized_path is None:
+        quantized_path = os.path.splitext(pre_trained_path)[0] + '_int8_' + method + '.pt'
+    save_quantized(quantized, quantized_path)
+
+    test_data, data_size = load_data(mode, target, data_transforms, loader_kwargs=loader_kwargs)
+    fp32_acc, fp32_speed = _timed_verify(model, test_data, data_size, target, model_name)
+    int8_acc, int8_speed = _timed_verify(quantized, test_data, data_size, target, model_name + '_int8_' + method)
+    print('fp32: acc {:.4f}, {:.1f} images/sec'.format(fp32_acc, fp32_speed))
+    print('int8 {}: acc {:.4f}, {:.1f} images/sec'.format(method, int8_acc, int8_speed))
+    print('Accuracy delta {:+.4f}, speedup {:.2f}x (including decoding)'.format(int8_acc - fp32_acc,
+                                                                                int8_speed / fp32_speed))
+    return quantized_path
@@ -1,13 +1,20 @@
 import os
-import pandas as pd
 import torch
 import time
 import copy
+import contextlib
 from torch.utils.data import Dataset
 from torchvision import transforms
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from PIL import Image
 from Classification_helper import verify_model
+from Data_helper import split_resize, build_image_cache, loader_config, load_annotation_index, ProgressiveResize, \
+    with_progressive_resize
+from Checkpoint_helper import AsyncCheckpointWriter, snapshot, load_checkpoint
+from Distributed_helper import is_distributed, is_main_process, unwrap_model, all_reduce_sum, barrier
+from Monitor_helper import TrainingMonitor
+from Validation_helper import AsyncValidator
 from tqdm import tqdm
 
 # data_transforms = transforms.Compose([transforms.Resize([512, 512]),
@@ -31,6 +38,12 @@ Sample Mean and Std in (r,g,b) from validation set
 Could increase accuracy
 '''
 
+# Memory formats selectable for training, channels_last is faster for convolutions with oneDNN on modern x86
+MEMORY_FORMATS = {
+    'contiguous': torch.contiguous_format,
+    'channels_last': torch.channels_last
+}
+
 CLASSDICT = {
     'species': 31,
     'genus': 15
@@ -46,18 +59,22 @@ class CustomImageDataset(Dataset):
     """
     DataLoader class. Sub-class of torch.utils.data Dataset class. It will load data from designated files.
     """
-    def __init__(self, annotations_file, img_dir, transform=None, target_transform=None):
+    def __init__(self, annotations_file, img_dir, transform=None, target_transform=None, cache=None,
+                 share_memory=False):
         """
         Initial function. Creates the instance.
         :param annotations_file: The file containing image directory and labels (for train and validation)
         :param img_dir: The directory containing target images.
         :param transform: Transformation applied to images. Should be a torchvision.transform type.
         :param target_transform:
+        :param cache: Optional Data_helper.ImageCache of pre-resized images. The transform then receives uint8 tensors.
+        :param share_memory: Keep the annotation index in shared memory for the DataLoader workers.
         """
-        self.img_labels = pd.read_csv(annotations_file, header=None)
+        self.img_labels = load_annotation_index(annotations_file, img_dir, share_memory)
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        self.cache = cache
 
     def __len__(self):
         return len(self.img_labels)
@@ -71,10 +88,13 @@ class CustomImageDataset(Dataset):
         img_path: path to the image.
         """
 
-        img_path = os.path.join(self.img_dir, self.img_labels.iloc[idx, 0])
+        img_path = self.img_labels.path(idx)
         # image = read_image(img_path)
-        image = Image.open(img_path)
-        label = self.img_labels.iloc[idx, 1]
+        if self.cache is not None:
+            image = self.cache[idx]
+        else:
+            image = Image.open(img_path)
+        label = self.img_labels.label(idx)
         if self.transform:
             image = self.transform(image)
         if self.target_transform:
@@ -82,107 +102,249 @@ class CustomImageDataset(Dataset):
         return image, label, img_path
 
 
-def train_model(model, criterion, optimizer, scheduler, num_epochs, dataloaders, dataset_sizes, device, tolerance=5):
+def autocast_context(device, precision='fp32'):
+    """
+    Context for the forward pass and loss. bf16 runs them under torch.autocast with bfloat16, fp32 is a no-op.
+    :param device: The torch.device the model is on.
+    :param precision: fp32 or bf16.
+    :return: A context manager.
+    """
+    if precision == 'bf16':
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    if precision != 'fp32':
+        raise ValueError('Unsupported precision: {}'.format(precision))
+    return contextlib.nullcontext()
+
+
+def train_model(model, criterion, optimizer, scheduler, num_epochs, dataloaders, dataset_sizes, device, tolerance=5,
+                precision='fp32', memory_format='contiguous', checkpoint_path=None, checkpoint_every=1, resume=None,
+                metrics_path=None, epoch_callback=None, progressive_resize=None, async_validation=False):
+    """
+    Training function of models. The model is trained on this function.
+    :param model: the decided model to be trained.
+    :param criterion: loss function of the model
+    :param optimizer: optimizer of training function. Should be subclass of torch.optim
+    :param scheduler: scheduler of the training function. Should be subclass of torch.scheduler
+    :param num_epochs: number of epochs we want to train
+    :param dataloaders: dictionary of data loaders for train and val
+    :param dataset_sizes: dictionary of sizes of the data sets
+    :param device: cpu or cuda
+    :param tolerance: epochs without improvement of the validation accuracy before early stopping
+    :param precision: fp32, or bf16 to run forward and loss under bfloat16 autocast.
+    :param memory_format: contiguous or channels_last, the layout of the input batches. The model should have been
+    converted to the same format.
+    :param checkpoint_path: file for periodic checkpoints, written in the background. None disables checkpoints.
+    :param checkpoint_every: write a checkpoint every n epochs.
+    :param resume: checkpoint to continue training from.
+    :param metrics_path: JSONL file for the per phase throughput records (images/sec, data wait, forward, backward and
+    optimizer time, peak memory). A summary table is printed at the end of training either way.
+    :param epoch_callback: called as epoch_callback(epoch, val_acc, val_loss) after every validation phase. Training
+    stops when it returns True, e.g. when a hyper-parameter search prunes the trial.
+    :param progressive_resize: Data_helper.ProgressiveResize of the train transform. It is set to the size of every
+    epoch before the train phase. Validation keeps the full resolution.
+    :param async_validation: validate in a separate process while the next epoch trains. The weights of every train
+    phase are sent to the worker, and early stopping, the best weights and epoch_callback consume the results at most
+    one epoch late. Checkpoints then hold the results validated so far. Not supported under torch.distributed.
+    Under torch.distributed the model is expected to be wrapped in DistributedDataParallel and the loaders to use a
+    DistributedSampler. Loss and accuracy are then summed over all workers, so every worker takes the same early
+    stopping decision, and only the first worker writes checkpoints.
+    :return: the model with the best validation weights and the path prefix for saving it
+    """
     since = time.time()
-    best_model_wts = copy.deepcopy(model.state_dict())
+    input_format = MEMORY_FORMATS[memory_format]
+    best_model_wts = copy.deepcopy(unwrap_model(model).state_dict())
     best_acc = 0.0
     # Sluggish factor is indicating how many rounds the loss doesn't improved
     sluggish = 0
     timelist=[]
-    for epoch in range(1, num_epochs+1):
-        epochsince = time.time()
-        print('Epoch {}/{}'.format(epoch, num_epochs))
-        print('-' * 10)
-        cnt = 0
-        # Each epoch has a training and validation phase
-        for phase in ['train', 'val']:
-            if phase == 'train':
-                model.train()  # Set model to training mode
-            else:
-                model.eval()  # Set model to evaluate mode
-
-            running_loss = 0.0
-            running_corrects = 0
-
-            # Iterate over data.
-            for inputs, labels, _ in tqdm(dataloaders[phase]):
-                inputs = inputs.to(device)
-                labels = labels.to(device)
-
-                # zero the parameter gradients
-                optimizer.zero_grad()
-
-                # forward
-                # track history if only in train
-                with torch.set_grad_enabled(phase == 'train'):
-                    outputs = model(inputs)
-                    _, preds = torch.max(outputs, 1)
-                    loss = criterion(outputs, labels)
-
-                    # backward + optimize only if in training phase
-                    if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
-
-                # statistics
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
-                cnt += 1
-                if cnt % 10 == 0:
-                    print("", end=f"\rCompleted: {cnt} Batches")
-            if phase == 'train':
-                scheduler.step()
-
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
-            # if phase == 'train':
-            #     trainloss.append(epoch_loss)
-            # else:
-            #     valloss.append(epoch_loss)
-
-            print('{} Loss: {:.4f} Acc: {:.4f}'.format(
-                phase, epoch_loss, epoch_acc))
-
-            # deep copy the model
-            if phase == 'val':
-                # tune.report(loss=epoch_loss, accuracy=epoch_acc)
-                sluggish += 1
-                if epoch_acc > best_acc:
-                    best_acc = epoch_acc
-                    best_model_wts = copy.deepcopy(model.state_dict())
-                    sluggish = 0
-
-        if sluggish >= tolerance:
-            print(f'Best validation loss did not improved over {tolerance} epochs. Break.')
-            break
-
-        timelist.append(time.time()-epochsince)
-        print(f'Time for epoch {epoch}: {(timelist[-1] // 60):.0f}m {(timelist[-1] % 60):.0f}s.')
-        remainingtime = (num_epochs-epoch)*(sum(timelist)/len(timelist))
-        print(f'Estimated remaining time: {(remainingtime // 60):.0f}m {(remainingtime % 60):.0f}s.')
-        finishingtime = time.localtime(time.time()+remainingtime)
-        print(f'Estimated finishing time: {finishingtime.tm_year}/{finishingtime.tm_mon}/{finishingtime.tm_mday} {finishingtime.tm_hour}:{finishingtime.tm_min}')
-
-
+    start_epoch = 1
+    if resume is not None:
+        checkpoint = load_checkpoint(resume, unwrap_model(model), optimizer, scheduler, device)
+        start_epoch = checkpoint['epoch'] + 1
+        best_acc = checkpoint['best_acc']
+        best_model_wts = checkpoint['best_model_wts']
+        sluggish = checkpoint['sluggish']
+        timelist = checkpoint['timelist']
+        if checkpoint.get('stopped', False):
+            print('The checkpointed run stopped early after epoch {}, not training further.'.format(
+                checkpoint['epoch']))
+            start_epoch = num_epochs + 1
+    writer = None
+    if checkpoint_path is not None and checkpoint_every > 0 and is_main_process():
+        writer = AsyncCheckpointWriter(checkpoint_path)
+    monitor = TrainingMonitor(metrics_path if is_main_process() else None, device)
+    phases = ['train', 'val']
+    validator = None
+    if async_validation:
+        if is_distributed():
+            raise ValueError('Asynchronous validation is not supported under torch.distributed.')
+        phases = ['train']
+        validator = AsyncValidator(unwrap_model(model), dataloaders['val'], criterion, device, precision,
+                                   memory_format)
+    try:
+        for epoch in range(start_epoch, num_epochs+1):
+            epochsince = time.time()
+            print('Epoch {}/{}'.format(epoch, num_epochs))
+            print('-' * 10)
+            cnt = 0
+            # Each epoch has a training and validation phase
+            for phase in phases:
+                if phase == 'train':
+                    model.train()  # Set model to training mode
+                else:
+                    model.eval()  # Set model to evaluate mode
+
+                running_loss = 0.0
+                running_corrects = 0
+                running_count = 0
+                if isinstance(dataloaders[phase].sampler, DistributedSampler):
+                    dataloaders[phase].sampler.set_epoch(epoch)
+                if phase == 'train' and progressive_resize is not None:
+                    size = progressive_resize.set_epoch(epoch)
+                    print('Training resolution: {}'.format('{0}x{0}'.format(size) if size > 0 else 'full'))
+                monitor.start_phase(epoch, phase)
+
+                # Iterate over data.
+                for inputs, labels, _ in tqdm(monitor.iterate(dataloaders[phase]), total=len(dataloaders[phase]),
+                                              disable=not is_main_process()):
+                    inputs = inputs.to(device, memory_format=input_format)
+                    labels = labels.to(device)
+
+                    # zero the parameter gradients
+                    optimizer.zero_grad()
+
+                    # forward
+                    # track history if only in train
+                    with torch.set_grad_enabled(phase == 'train'):
+                        with monitor.time('forward'), autocast_context(device, precision):
+                            outputs = model(inputs)
+                            loss = criterion(outputs, labels)
+                        _, preds = torch.max(outputs, 1)
+
+                        # backward + optimize only if in training phase
+                        if phase == 'train':
+                            with monitor.time('backward'):
+                                loss.backward()
+                            with monitor.time('optimizer'):
+                                optimizer.step()
+
+                    # statistics
+                    running_loss += loss.item() * inputs.size(0)
+                    running_corrects += torch.sum(preds == labels.data)
+                    running_count += inputs.size(0)
+                    cnt += 1
+                    if cnt % 10 == 0:
+                        print("", end=f"\rCompleted: {cnt} Batches")
+                if phase == 'train':
+                    scheduler.step()
+                monitor.end_phase(running_count)
+
+                if is_distributed():
+                    # Every worker only saw its shard, sum the statistics over all workers
+                    running_loss, total_corrects, phase_size = all_reduce_sum([running_loss, running_corrects,
+                                                                               running_count])
+                    running_corrects = torch.tensor(total_corrects)
+                else:
+                    phase_size = dataset_sizes[phase]
+                epoch_loss = running_loss / phase_size
+                epoch_acc = running_corrects.double() / phase_size
+                # if phase == 'train':
+                #     trainloss.append(epoch_loss)
+                # else:
+                #     valloss.append(epoch_loss)
+
+                print('{} Loss: {:.4f} Acc: {:.4f}'.format(
+                    phase, epoch_loss, epoch_acc))
+
+                # deep copy the model
+                if phase == 'val':
+                    sluggish += 1
+                    if epoch_acc > best_acc:
+                        best_acc = epoch_acc
+                        best_model_wts = copy.deepcopy(unwrap_model(model).state_dict())
+                        sluggish = 0
+
+            # (epoch, loss, accuracy) of the validation results of this epoch
+            val_results = [(epoch, epoch_loss, epoch_acc)]
+            if validator is not None:
+                validator.submit(epoch, unwrap_model(model))
+                # The previous epoch was validated while this one trained, wait for it so validation stays at most one
+                # epoch behind. The last epoch is waited for.
+                val_results = []
+                for val_epoch, val_loss, val_acc, weights in validator.collect(pending=0 if epoch == num_epochs else 1):
+                    val_acc = torch.tensor(val_acc, dtype=torch.float64)
+                    print('val (epoch {}) Loss: {:.4f} Acc: {:.4f}'.format(val_epoch, val_loss, val_acc))
+                    sluggish += 1
+                    if val_acc > best_acc:
+                        best_acc = val_acc
+                        best_model_wts = weights
+                        sluggish = 0
+                    val_results.append((val_epoch, val_loss, val_acc))
+
+            stopped = False
+            if sluggish >= tolerance:
+                print(f'Best validation loss did not improved over {tolerance} epochs. Break.')
+                stopped = True
+            elif epoch_callback is not None and any(epoch_callback(val_epoch, float(val_acc), float(val_loss))
+                                                    for val_epoch, val_loss, val_acc in val_results):
+                print(f'Stopped by the epoch callback after epoch {epoch}.')
+                stopped = True
+
+            timelist.append(time.time()-epochsince)
+            # The epoch of an early stop is saved too, so a resumed run does not train past it
+            if writer is not None and (epoch % checkpoint_every == 0 or epoch == num_epochs or stopped):
+                writer.submit(snapshot(epoch, unwrap_model(model), optimizer, scheduler, best_acc, best_model_wts,
+                                       sluggish, timelist, stopped))
+            if stopped:
+                break
+            print(f'Time for epoch {epoch}: {(timelist[-1] // 60):.0f}m {(timelist[-1] % 60):.0f}s.')
+            remainingtime = (num_epochs-epoch)*(sum(timelist)/len(timelist))
+            print(f'Estimated remaining time: {(remainingtime // 60):.0f}m {(remainingtime % 60):.0f}s.')
+            finishingtime = time.localtime(time.time()+remainingtime)
+            print(f'Estimated finishing time: {finishingtime.tm_year}/{finishingtime.tm_mon}/{finishingtime.tm_mday} {finishingtime.tm_hour}:{finishingtime.tm_min}')
+    finally:
+        # A queued checkpoint is written and the validation worker stopped also when training fails
+        if writer is not None:
+            writer.close()
+        if validator is not None:
+            validator.close()
+    monitor.summary()
     time_elapsed = time.time() - since
     print('Training complete in {:.0f}m {:.0f}s'.format(
         time_elapsed // 60, time_elapsed % 60))
     print('Best val Acc: {:4f}'.format(best_acc))
 
     # load best model weights
-    model.load_state_dict(best_model_wts)
+    unwrap_model(model).load_state_dict(best_model_wts)
     model_save_path = PATH+str(int(time.time()))+'_'+str(best_acc.cpu().data.numpy().round(decimals=2))
     #torch.save(model.state_dict(), model_save_path)
     return model, model_save_path
 
 
 # Load train, test and validation data by phase. Phase = train, val and test. Target = genus and species
-def load_data(phase, target, d_transfroms, batch_size=16):
+# cache_dir enables the pre-decoded image cache, the Resize of d_transfroms is then only done when the cache is built
+# loader_kwargs are passed to the DataLoader, see Data_helper.loader_config. Defaults to the auto configuration.
+# share_memory keeps the annotation index in shared memory for the workers
+def load_data(phase, target, d_transfroms, batch_size=16, cache_dir=None, loader_kwargs=None, share_memory=False):
     data_path = './Metadata/' + target + '_' + phase + '.csv'
     src_path = ''
-    data_out = CustomImageDataset(data_path, src_path, d_transfroms)
+    cache = None
+    if cache_dir is not None:
+        resize, d_transfroms = split_resize(d_transfroms)
+        # Under torch.distributed the first worker builds the cache, the others open it when it is finished
+        if is_main_process():
+            cache = build_image_cache(data_path, src_path, resize, cache_dir)
+        barrier()
+        if cache is None:
+            cache = build_image_cache(data_path, src_path, resize, cache_dir)
+    data_out = CustomImageDataset(data_path, src_path, d_transfroms, cache=cache, share_memory=share_memory)
     data_size = len(data_out)
-    data_loader = DataLoader(data_out, batch_size=batch_size, shuffle=True)
+    if loader_kwargs is None:
+        loader_kwargs = loader_config()
+    # Under torch.distributed every worker loads its own shard of the csv
+    sampler = DistributedSampler(data_out, shuffle=True) if is_distributed() else None
+    data_loader = DataLoader(data_out, batch_size=batch_size, shuffle=sampler is None, sampler=sampler,
+                             **loader_kwargs)
     return data_loader, data_size
 
 """----------------------------------to be modified----------------------------------"""
@@ -209,15 +371,34 @@ def std_call_train(model, batch_size = 96):
                           exp_lr_scheduler, num_epochs=25,dataloaders=dataloaders,dataset_sizes=dataset_sizes,device=device)
     return model_ft
 
-def single_train(model, target, batch_size, n_epochs, criterion, optimizer, scheduler):
+def single_train(model, target, batch_size, n_epochs, criterion, optimizer, scheduler, cache_dir=None,
+                 loader_kwargs=None, share_memory=False, precision='fp32', memory_format='contiguous',
+                 checkpoint_path=None, checkpoint_every=1, resume=None, metrics_path=None, epoch_callback=None,
+                 resize_schedule=None, async_validation=False):
     os.chdir(DEFAULTWD)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = model.to(device)
+    model = model.to(device, memory_format=MEMORY_FORMATS[memory_format])
+    if is_distributed():
+        model = torch.nn.parallel.DistributedDataParallel(model)
+    # resize_schedule, e.g. [(128, 3), (176, 3)], shrinks the training images of the first epochs
+    progressive = None
+    train_transforms = data_transforms
+    if resize_schedule:
+        progressive = ProgressiveResize(resize_schedule)
+        train_transforms = with_progressive_resize(data_transforms, progressive)
     dataloaders, dataset_sizes = [{}, {}]
-    dataloaders['train'], dataset_sizes['train'] = load_data('train', target, data_transforms, batch_size)
-    dataloaders['val'], dataset_sizes['val'] = load_data('val', target, data_transforms, batch_size)
+    dataloaders['train'], dataset_sizes['train'] = load_data('train', target, train_transforms, batch_size,
+                                                             cache_dir=cache_dir, loader_kwargs=loader_kwargs,
+                                                             share_memory=share_memory)
+    dataloaders['val'], dataset_sizes['val'] = load_data('val', target, data_transforms, batch_size,
+                                                         cache_dir=cache_dir, loader_kwargs=loader_kwargs,
+                                                         share_memory=share_memory)
     model_ft = train_model(model=model, criterion=criterion, optimizer=optimizer,
-                          scheduler=scheduler, num_epochs=n_epochs, dataloaders=dataloaders, dataset_sizes=dataset_sizes, device=device)
+                          scheduler=scheduler, num_epochs=n_epochs, dataloaders=dataloaders, dataset_sizes=dataset_sizes, device=device,
+                          precision=precision, memory_format=memory_format, checkpoint_path=checkpoint_path,
+                          checkpoint_every=checkpoint_every, resume=resume, metrics_path=metrics_path,
+                          epoch_callback=epoch_callback, progressive_resize=progressive,
+                          async_validation=async_validation)
     return model_ft
 
 
@@ -228,12 +409,13 @@ def tune_train(config, model, target):
     model = model.to(device)
 
 
-def test_model(model, pre_trained_path, target, model_name, mode):
+def test_model(model, pre_trained_path, target, model_name, mode, cache_dir=None, loader_kwargs=None, top_k=0,
+               output_format='csv'):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model.load_state_dict(torch.load(pre_trained_path, map_location=torch.device(device)))
     model = model.to(device)
-    test_data, data_size = load_data(mode, target, data_transforms)
-    verify_model(model, test_data, device, target, data_size, model_name)
+    test_data, data_size = load_data(mode, target, data_transforms, cache_dir=cache_dir, loader_kwargs=loader_kwargs)
+    verify_model(model, test_data, device, target, data_size, model_name, top_k, output_format)
 
 
 def loading_data():
@@ -0,0 +1,123 @@
+import copy
+import queue
+import time
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+''' Validation in a separate process, overlapping with the next training epoch. '''
+''' Functions included:
+    1. A validation worker process holding its own copy of the model and a DataLoader over the validation set. It
+       receives the weights after every train phase and reports loss and accuracy.
+    2. Collecting the results in the training loop, at most one epoch behind the training, so early stopping and the
+       best weights of train_model still see every validation result.
+    The worker gets a share of the cpu threads, the training keeps the rest while both run.
+'''
+
+# Share of the torch threads given to the validation worker, at least one
+VALIDATION_THREADS_SHARE = 0.25
+
+
+def _validation_worker(model, dataset, batch_size, criterion, device, precision, memory_format, threads, jobs,
+                       results):
+    # Imported here, Train imports this module
+    from Train import autocast_context, MEMORY_FORMATS
+
+    torch.set_num_threads(threads)
+    input_format = MEMORY_FORMATS[memory_format]
+    # Batches are decoded in this process, the training process keeps its DataLoader workers
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+    model = model.to(device, memory_format=input_format)
+    model.eval()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, state = job
+        since = time.time()
+        model.load_state_dict(state)
+        running_loss = 0.0
+        running_corrects = 0
+        running_count = 0
+        with torch.no_grad():
+            for inputs, labels, _ in loader:
+                inputs = inputs.to(device, memory_format=input_format)
+                labels = labels.to(device)
+                with autocast_context(device, precision):
+                    outputs = model(inputs)
+                    loss = criterion(outputs, labels)
+                running_loss += loss.item() * inputs.size(0)
+                running_corrects += int(torch.sum(outputs.argmax(1) == labels))
+                running_count += inputs.size(0)
+        results.put((epoch, running_loss / running_count, running_corrects / running_count, time.time() - since))
+
+
+class AsyncValidator:
+    """
+    Runs the validation phase of train_model in a spawned worker process.
+    """
+    def __init__(self, model, val_loader, criterion, device, precision='fp32', memory_format='contiguous',
+                 threads=None):
+        """
+        :param model: The model being trained, without DistributedDataParallel. A cpu copy is sent to the worker.
+        :param val_loader: DataLoader of the validation set, its dataset and batch size are used by the worker.
+        :param threads: Torch threads of the worker. Defaults to VALIDATION_THREADS_SHARE of the current threads,
+        which are taken from the training process until close().
+        """
+        self.train_threads = torch.get_num_threads()
+        if threads is None:
+            threads = max(1, int(self.train_threads * VALIDATION_THREADS_SHARE))
+        torch.set_num_threads(max(1, self.train_threads - threads))
+        context = mp.get_context('spawn')
+        # Only one set of weights waits while another is validated
+        self._jobs = context.Queue(maxsize=1)
+        self._results = context.Queue()
+        # Submitted weights are kept until their result arrives, they become the best weights if they improved
+        self._pending = {}
+        args = (copy.deepcopy(model).to('cpu'), val_loader.dataset, val_loader.batch_size, criterion, device,
+                precision, memory_format, threads, self._jobs, self._results)
+        self._process = context.Process(target=_validation_worker, args=args, daemon=True)
+        self._process.start()
+
+    def submit(self, epoch, model):
+        """
+        Send a copy of the current weights for validation.
+        """
+        state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        self._pending[epoch] = state
+        self._jobs.put((epoch, state))
+
+    def collect(self, pending=0):
+        """
+        Wait for results until at most `pending` submitted epochs are still unvalidated.
+        :return: List of (epoch, loss, accuracy, weights) in epoch order. weights is the validated state dict.
+        """
+        collected = []
+        while len(self._pending) > pending:
+            try:
+                epoch, loss, acc, seconds = self._results.get(timeout=5)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError('The validation worker stopped with exit code {}'.format(
+                        self._process.exitcode))
+                continue
+            print('val of epoch {} took {:.0f}s'.format(epoch, seconds))
+            collected.append((epoch, loss, acc, self._pending.pop(epoch)))
+        return sorted(collected, key=lambda r: r[0])
+
+    def close(self):
+        """
+        Stop the worker, dropping unvalidated epochs, and give the threads back to training.
+        """
+        if self._process.is_alive():
+            try:
+                self._jobs.get_nowait()
+            except queue.Empty:
+                pass
+            self._jobs.put(None)
+            self._process.join(timeout=60)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._pending.clear()
+        torch.set_num_threads(self.train_threads)
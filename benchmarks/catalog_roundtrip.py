@@ -0,0 +1,104 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Dataset_catalog import connect, import_all, export_all, find_labels, guide
+from metadata_helper import label_all
+
+"""
+Check that Dataset_catalog.py follows the csv files: import and export the project csvs, then relabel species.csv with
+a higher threshold, import again and check that the export and the lookups only hold the new labels.
+
+    python benchmarks/catalog_roundtrip.py --root .
+
+The csv files are copied to a temporary directory, the project files are not changed. The script exits with an error
+when an exported file differs from its source. Files of Metadata/ and Data_organized/ are compared as sets of rows,
+the catalog keeps its own row order for them.
+"""
+
+EXACT_FILES = ['input.csv', 'output.csv', 'species.csv', 'species_guide.csv', 'genus.csv', 'genus_guide.csv',
+               'all_records.csv']
+ROW_SET_DIRS = ['Metadata', 'Data_organized']
+
+
+def _lines(path):
+    with open(path, 'rb') as f_in:
+        return f_in.read()
+
+
+def compare_trees(source, exported):
+    """
+    :return: List of the files of source that differ in exported.
+    """
+    differences = []
+    for name in EXACT_FILES:
+        if os.path.exists(os.path.join(source, name)):
+            exported_path = os.path.join(exported, name)
+            if not os.path.exists(exported_path) or _lines(os.path.join(source, name)) != _lines(exported_path):
+                differences.append(name)
+    for directory in ROW_SET_DIRS:
+        if not os.path.isdir(os.path.join(source, directory)):
+            continue
+        for name in sorted(os.listdir(os.path.join(source, directory))):
+            exported_path = os.path.join(exported, directory, name)
+            if not os.path.exists(exported_path) or sorted(_lines(os.path.join(source, directory, name)).splitlines()) \
+                    != sorted(_lines(exported_path).splitlines()):
+                differences.append(os.path.join(directory, name))
+    return differences
+
+
+def roundtrip(source, exported, catalog):
+    import_all(catalog, source)
+    if os.path.exists(exported):
+        shutil.rmtree(exported)
+    export_all(catalog, exported)
+    return compare_trees(source, exported)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='.', help='directory of input.csv, species.csv, Metadata/ etc.')
+    parser.add_argument('--treshold', type=int, default=500, help='species threshold of the relabelled species.csv')
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as work:
+        source = os.path.join(work, 'source')
+        os.makedirs(source)
+        for name in EXACT_FILES:
+            if os.path.exists(os.path.join(args.root, name)):
+                shutil.copy(os.path.join(args.root, name), source)
+        for directory in ROW_SET_DIRS:
+            if os.path.isdir(os.path.join(args.root, directory)):
+                shutil.copytree(os.path.join(args.root, directory), os.path.join(source, directory))
+        catalog = connect(os.path.join(work, 'catalog.sqlite'))
+
+        failures += ['first import: ' + name for name in roundtrip(source, os.path.join(work, 'first'), catalog)]
+
+        # Fewer species classes, the labels of the remaining classes change
+        label_all(os.path.join(source, 'input.csv'), os.path.join(source, 'species.csv'),
+                  os.path.join(source, 'species_guide.csv'), os.path.join(source, 'genus.csv'),
+                  os.path.join(source, 'genus_guide.csv'), treshold=args.treshold)
+        failures += ['re-import: ' + name for name in roundtrip(source, os.path.join(work, 'second'), catalog)]
+        with open(os.path.join(source, 'species_guide.csv'), 'r', encoding='ascii') as f_guide:
+            classes = [line.split(',')[0] for line in f_guide.read().splitlines()]
+        with open(os.path.join(source, 'species.csv'), 'r', encoding='ascii') as f_labels:
+            listed = len(f_labels.read().splitlines())
+        if guide(catalog, 'species') != classes:
+            failures.append('re-import: guide of species')
+        labels = find_labels(catalog, 'species')
+        labels = labels[labels['listed'] == 1]
+        if len(labels) != listed or labels['label'].max() >= len(classes):
+            failures.append('re-import: labels of species')
+        print('species.csv: {} rows, {} classes after relabelling'.format(listed, len(classes)))
+        catalog.close()
+
+    for failure in failures:
+        print('Differs:', failure)
+    print('{} differences'.format(len(failures)))
+    if failures:
+        sys.exit(1)
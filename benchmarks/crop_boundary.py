@@ -0,0 +1,126 @@
+import os
+import sys
+import glob
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Image_handler import calculateBoundary
+
+"""
+Check and time Image_handler.calculateBoundary against the former per pixel implementation.
+
+    python benchmarks/crop_boundary.py
+    python benchmarks/crop_boundary.py --images "./Data/*/images/*.jpg" --limit 500
+
+The golden set are deterministic synthetic forum images (dark background, bright specimen, optional white scale box
+in the lower left, plus corner cases without specimen or box, with a specimen touching the borders and tiny images)
+and, with --images, real images. Every image must give the same top, bottom, left and right with both
+implementations, otherwise the script exits with an error. The time per image of both is printed.
+"""
+
+
+def reference_boundary(image, height, length):
+    """
+    calculateBoundary before vectorization, the reference of the golden set.
+    """
+    startingPXL = [height // 4, length // 2]
+    top = -1
+    bottom = height - 1
+    left = -1
+    right = length - 1
+    low_bound = -1
+    for i in range(0, height):
+        if top == -1 and int(image[i][startingPXL[1]][0]) + int(image[i][startingPXL[1]][1]) + int(
+                image[i][startingPXL[1]][2]) > 6:
+            top = i
+        if low_bound == -1 and i >= 30 and int(image[i][9][0]) + int(image[i][9][1]) + int(image[i][9][2]) >= 751:
+            low_bound = i
+        if top != -1 and int(image[i][startingPXL[1]][0]) + int(image[i][startingPXL[1]][1]) + int(
+                image[i][startingPXL[1]][2]) <= 6:
+            if i - top > 60:
+                bottom = i
+                break
+    if low_bound != -1 and low_bound >= top*2:
+        startingPXL[0] = low_bound//2
+    for j in range(0, length):
+        if left == -1 and int(image[startingPXL[0]][j][0]) + int(image[startingPXL[0]][j][1]) + int(
+                image[startingPXL[0]][j][2]) > 6:
+            left = j
+            right = right-j
+            break
+    if bottom > low_bound != -1:
+        bottom = low_bound
+    if top == -1:
+        top = 0
+    if left == -1:
+        left = 0
+    return top, bottom, left, right
+
+
+def synthetic_image(rng, height, width, specimen=True, box=True, border=False):
+    image = rng.randint(0, 3, size=(height, width, 3)).astype(np.uint8)
+    if specimen:
+        if border:
+            y0, y1, x0, x1 = 0, height, 0, width
+        else:
+            y0 = rng.randint(0, height // 3)
+            y1 = rng.randint(y0 + 1, height)
+            x0 = rng.randint(0, width // 3)
+            x1 = rng.randint(x0 + 1, width)
+        image[y0:y1, x0:x1] = rng.randint(20, 230, size=(y1 - y0, x1 - x0, 3))
+        # Dark holes, so some dark pixels fall inside the specimen
+        for _ in range(rng.randint(0, 4)):
+            y, x = rng.randint(0, height), rng.randint(0, width)
+            image[y:y + rng.randint(1, 80), x:x + rng.randint(1, 20)] = 0
+    if box:
+        y = rng.randint(0, height)
+        image[y:y + rng.randint(1, 60), 0:rng.randint(10, width + 1)] = 255 - rng.randint(0, 3)
+    return image
+
+
+def golden_set(n_images, seed=0):
+    rng = np.random.RandomState(seed)
+    images = [np.zeros((120, 100, 3), dtype=np.uint8), np.full((120, 100, 3), 255, dtype=np.uint8),
+              synthetic_image(rng, 20, 12), synthetic_image(rng, 64, 40, border=True)]
+    for idx in range(n_images):
+        height, width = rng.randint(20, 700), rng.randint(10, 600)
+        images.append(synthetic_image(rng, height, width, specimen=idx % 7 != 0, box=idx % 3 != 0,
+                                      border=idx % 11 == 0))
+    return images
+
+
+def timed(function, images, repeat):
+    since = time.perf_counter()
+    for _ in range(repeat):
+        results = [function(image, image.shape[0], image.shape[1]) for image in images]
+    return results, (time.perf_counter() - since) / (repeat * len(images))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--synthetic', type=int, default=300, help='number of synthetic images')
+    parser.add_argument('--images', type=str, default=None, help='glob of real images added to the golden set')
+    parser.add_argument('--limit', type=int, default=200, help='largest number of real images')
+    parser.add_argument('--repeat', type=int, default=3, help='timed passes over the images')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic images')
+    args = parser.parse_args()
+
+    images = golden_set(args.synthetic, args.seed)
+    if args.images:
+        for path in sorted(glob.glob(args.images))[:args.limit]:
+            images.append(np.array(Image.open(path).convert('RGB')))
+    expected, reference_time = timed(reference_boundary, images, args.repeat)
+    results, vectorized_time = timed(calculateBoundary, images, args.repeat)
+    mismatches = [(idx, e, r) for idx, (e, r) in enumerate(zip(expected, results)) if e != r]
+    for idx, e, r in mismatches[:10]:
+        print('image {} {}: expected {}, got {}'.format(idx, images[idx].shape, e, r))
+    print('{} images, {} mismatches'.format(len(images), len(mismatches)))
+    print('per pixel loops: {:.3f} ms/image, numpy: {:.3f} ms/image, speedup {:.1f}x'.format(
+        1000 * reference_time, 1000 * vectorized_time, reference_time / vectorized_time))
+    if mismatches:
+        sys.exit(1)
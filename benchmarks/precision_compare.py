@@ -0,0 +1,119 @@
+import os
+import sys
+import csv
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Model_registry import determine_model
+from Train import MEMORY_FORMATS, autocast_context, load_data, data_transforms
+
+"""
+Compare training throughput and accuracy of the precision and memory format options of entrance.py
+(--precision fp32/bf16, --memory_format contiguous/channels_last) on the resnet and vgg variants of determine_model.
+
+    python benchmarks/precision_compare.py --models resnet50 vgg16 --weights resnet50=Models/xxx_species_resnet50.pth
+
+Images/sec is measured on train steps (forward, loss, backward, optimizer step) with a random batch. Accuracy is
+measured on the first batches of Metadata/{target}_val.csv, together with the agreement of the predictions with fp32.
+Without --weights the accuracy of an untrained head is meaningless, but the agreement still shows the bf16 error.
+"""
+
+MODELS = ['resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152', 'vgg16', 'vgg19']
+CONFIGS = [('fp32', 'contiguous'), ('fp32', 'channels_last'), ('bf16', 'contiguous'), ('bf16', 'channels_last')]
+
+
+def train_throughput(model, precision, memory_format, batch_size, classes, steps, warmup):
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+    criterion = torch.nn.CrossEntropyLoss()
+    device = torch.device('cpu')
+    inputs = torch.randn(batch_size, 3, 224, 224).to(memory_format=MEMORY_FORMATS[memory_format])
+    labels = torch.randint(0, classes, (batch_size,))
+    for step in range(warmup + steps):
+        if step == warmup:
+            since = time.time()
+        optimizer.zero_grad()
+        with autocast_context(device, precision):
+            outputs = model(inputs)
+            loss = criterion(outputs, labels)
+        loss.backward()
+        optimizer.step()
+    return steps * batch_size / (time.time() - since)
+
+
+def val_predictions(model, precision, memory_format, batches):
+    model.eval()
+    device = torch.device('cpu')
+    all_predictions = []
+    all_labels = []
+    with torch.no_grad():
+        for inputs, labels in batches:
+            with autocast_context(device, precision):
+                outputs = model(inputs.to(memory_format=MEMORY_FORMATS[memory_format]))
+            all_predictions.append(torch.argmax(outputs, 1))
+            all_labels.append(labels)
+    return torch.cat(all_predictions), torch.cat(all_labels)
+
+
+def compare(models, weights, target, classes, batch_size, steps, warmup, val_batches):
+    batches = []
+    if os.path.exists('./Metadata/' + target + '_val.csv'):
+        val_loader, _ = load_data('val', target, data_transforms, batch_size)
+        for inputs, labels, _ in val_loader:
+            batches.append((inputs, labels))
+            if len(batches) >= val_batches:
+                break
+    rows = []
+    for model_name in models:
+        model = determine_model(model_name, False, classes)
+        if model_name in weights:
+            model.load_state_dict(torch.load(weights[model_name], map_location='cpu'))
+        initial_state = {k: v.clone() for k, v in model.state_dict().items()}
+        reference = None
+        for precision, memory_format in CONFIGS:
+            model.load_state_dict(initial_state)
+            model = model.to(memory_format=MEMORY_FORMATS[memory_format])
+            row = {'model': model_name, 'precision': precision, 'memory_format': memory_format, 'accuracy': '',
+                   'agreement': ''}
+            if batches:
+                predictions, labels = val_predictions(model, precision, memory_format, batches)
+                if reference is None:
+                    reference = predictions
+                row['accuracy'] = round(float((predictions == labels).double().mean()), 4)
+                row['agreement'] = round(float((predictions == reference).double().mean()), 4)
+            row['images_per_sec'] = round(train_throughput(model, precision, memory_format, batch_size, classes,
+                                                           steps, warmup), 2)
+            print(row)
+            rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs='+', default=MODELS, help="Models of determine_model to compare.")
+    parser.add_argument("--weights", nargs='*', default=[], help="Trained weights as model=path pairs.")
+    parser.add_argument("--target", type=str, default='species', help="species or genus.")
+    parser.add_argument("--classes", type=int, default=31, help="The count of classes for classification.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size for throughput and validation.")
+    parser.add_argument("--steps", type=int, default=10, help="Timed train steps per configuration.")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed train steps per configuration.")
+    parser.add_argument("--val_batches", type=int, default=10, help="Validation batches used for the accuracy.")
+    parser.add_argument("--out", type=str, default='./Results/' + str(int(time.time())) + '_precision_compare.csv',
+                        help="Result csv.")
+    args = parser.parse_args()
+    if args.steps < 1:
+        parser.error('--steps must be at least 1')
+
+    weights = dict(pair.split('=', 1) for pair in args.weights)
+    rows = compare(args.models, weights, args.target, args.classes, args.batch_size, args.steps, args.warmup,
+                   args.val_batches)
+    with open(args.out, 'w', encoding='ascii', newline='') as f_out:
+        writer = csv.DictWriter(f_out, fieldnames=['model', 'precision', 'memory_format', 'images_per_sec',
+                                                   'accuracy', 'agreement'])
+        writer.writeheader()
+        writer.writerows(rows)
+    print('Results written to', args.out)
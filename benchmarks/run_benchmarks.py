@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_data import generate
+from Model_registry import determine_model, model_names
+from Train import CustomImageDataset, data_transforms
+from Data_helper import loader_config, split_resize, build_image_cache
+from Classification_helper import verify_model
+
+"""
+Benchmark suite of the classification pipeline on synthetic data (see benchmarks/synthetic_data.py).
+
+    python benchmarks/run_benchmarks.py --out benchmarks/results/$(git rev-parse --short HEAD).json
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/old.json
+
+Measured:
+    1. getitem: latency of CustomImageDataset.__getitem__, decoding from jpeg and from the pre-decoded image cache.
+    2. loader: DataLoader images/sec over one epoch for several worker counts.
+    3. model: forward and forward+backward images/sec of every architecture of determine_model.
+    4. verify_model: images/sec of the inference and result writing path.
+Results are written as JSON, one record per measurement, with the commit and library versions. --compare prints the
+ratio to an earlier result file, so regressions between commits are visible.
+"""
+
+MODELS = model_names()
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_getitem(root, csv_path, items):
+    results = []
+    dataset = CustomImageDataset(csv_path, root, data_transforms)
+    resize, rest = split_resize(data_transforms)
+    cache = build_image_cache(csv_path, root, resize, os.path.join(root, 'cache'))
+    cached = CustomImageDataset(csv_path, root, rest, cache=cache)
+    for name, data in [('jpeg', dataset), ('cache', cached)]:
+        latencies = []
+        for idx in range(min(items, len(data))):
+            since = time.perf_counter()
+            data[idx]
+            latencies.append(time.perf_counter() - since)
+        latencies = np.array(latencies) * 1000
+        results.append({'benchmark': 'getitem', 'source': name, 'items': len(latencies),
+                        'mean_ms': round(float(latencies.mean()), 3),
+                        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+                        'p95_ms': round(float(np.percentile(latencies, 95)), 3)})
+    return results
+
+
+def bench_loader(root, csv_path, batch_size, worker_counts):
+    results = []
+    dataset = CustomImageDataset(csv_path, root, data_transforms)
+    for workers in worker_counts:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                            **loader_config(num_workers=workers, persistent_workers=False))
+        since = time.perf_counter()
+        images = sum(len(labels) for _, labels, _ in loader)
+        seconds = time.perf_counter() - since
+        results.append({'benchmark': 'loader', 'num_workers': workers, 'images': images,
+                        'images_per_sec': round(images / seconds, 2)})
+    return results
+
+
+def bench_model(model_name, classes, batch_size, steps):
+    record = {'benchmark': 'model', 'model': model_name, 'batch_size': batch_size}
+    try:
+        model = determine_model(model_name, False, classes)
+    except Exception as e:
+        record['error'] = str(e)
+        return [record]
+    inputs = torch.randn(batch_size, 3, 224, 224)
+    labels = torch.randint(0, classes, (batch_size,))
+    criterion = torch.nn.CrossEntropyLoss()
+    try:
+        model.eval()
+        with torch.no_grad():
+            model(inputs)
+            since = time.perf_counter()
+            for _ in range(steps):
+                model(inputs)
+            record['forward_images_per_sec'] = round(steps * batch_size / (time.perf_counter() - since), 2)
+        model.train()
+        criterion(model(inputs), labels).backward()
+        since = time.perf_counter()
+        for _ in range(steps):
+            model.zero_grad()
+            criterion(model(inputs), labels).backward()
+        record['train_images_per_sec'] = round(steps * batch_size / (time.perf_counter() - since), 2)
+    except Exception as e:
+        record['error'] = str(e)
+    return [record]
+
+
+def bench_verify(root, csv_path, target, classes, batch_size):
+    model = determine_model('resnet18', False, classes)
+    dataset = CustomImageDataset(csv_path, root, data_transforms)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, **loader_config())
+    cwd = os.getcwd()
+    # verify_model reads the class guide and writes to ./Results relative to the working directory
+    os.chdir(root)
+    os.makedirs('Results', exist_ok=True)
+    try:
+        model.eval()
+        since = time.perf_counter()
+        verify_model(model, loader, torch.device('cpu'), target, len(dataset), 'benchmark')
+        seconds = time.perf_counter() - since
+    finally:
+        os.chdir(cwd)
+    return [{'benchmark': 'verify_model', 'model': 'resnet18', 'images': len(dataset),
+             'images_per_sec': round(len(dataset) / seconds, 2)}]
+
+
+def _record_key(record):
+    return tuple((k, record[k]) for k in ['benchmark', 'source', 'num_workers', 'model'] if k in record)
+
+
+def compare(results, old_path):
+    """
+    Print new/old ratios of every throughput (higher is better) and latency (lower is better) value.
+    """
+    with open(old_path, 'r') as f_old:
+        old = {_record_key(r): r for r in json.load(f_old)['results']}
+    print('{:<50} {:>12} {:>12} {:>8}'.format('measurement', 'old', 'new', 'ratio'))
+    for record in results:
+        previous = old.get(_record_key(record))
+        if previous is None:
+            continue
+        for field, value in record.items():
+            if (field.endswith('_per_sec') or field.endswith('_ms')) and previous.get(field):
+                name = ' '.join(str(v) for _, v in _record_key(record)) + ' ' + field
+                print('{:<50} {:>12} {:>12} {:>8.2f}'.format(name, previous[field], value, value / previous[field]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='./benchmarks/synthetic', help='synthetic data directory')
+    parser.add_argument('--images', type=int, default=256, help='number of synthetic images')
+    parser.add_argument('--classes', type=int, default=8, help='number of classes')
+    parser.add_argument('--target', type=str, default='species', help='target name of the csv files')
+    parser.add_argument('--batch_size', type=int, default=16, help='batch size')
+    parser.add_argument('--items', type=int, default=100, help='items timed by the getitem benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8], help='loader worker counts')
+    parser.add_argument('--models', nargs='*', default=MODELS, help='architectures of determine_model')
+    parser.add_argument('--steps', type=int, default=3, help='timed steps per model')
+    parser.add_argument('--skip', nargs='*', default=[], choices=['getitem', 'loader', 'model', 'verify_model'],
+                        help='benchmarks to skip')
+    parser.add_argument('--out', type=str, default=None, help='result file, default benchmarks/results/<time>.json')
+    parser.add_argument('--compare', type=str, default=None, help='earlier result file to compare with')
+    opt = parser.parse_args()
+
+    root = os.path.abspath(opt.root)
+    csv_paths = generate(root, opt.images, opt.classes, target=opt.target)
+    results = []
+    if 'getitem' not in opt.skip:
+        results += bench_getitem(root, csv_paths['train'], opt.items)
+    if 'loader' not in opt.skip:
+        results += bench_loader(root, csv_paths['train'], opt.batch_size, opt.workers)
+    if 'model' not in opt.skip:
+        for model_name in opt.models:
+            results += bench_model(model_name, opt.classes, opt.batch_size, opt.steps)
+    if 'verify_model' not in opt.skip:
+        results += bench_verify(root, csv_paths['test'], opt.target, opt.classes, opt.batch_size)
+    for record in results:
+        print(record)
+
+    out = opt.out
+    if out is None:
+        out = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', str(int(time.time())) + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f_out:
+        json.dump({'commit': _commit(), 'timestamp': int(time.time()), 'python': platform.python_version(),
+                   'torch': torch.__version__, 'cpu_count': os.cpu_count(), 'results': results}, f_out, indent=1)
+    print('Results written to', out)
+    if opt.compare is not None:
+        compare(results, opt.compare)
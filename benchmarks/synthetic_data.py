@@ -0,0 +1,85 @@
+import os
+import csv
+import argparse
+
+import numpy as np
+from PIL import Image
+
+"""
+Deterministic synthetic image folders and Metadata csv files with the same layout as the real data, so the
+classification pipeline can be benchmarked without the forum and ostracod images.
+
+    root/
+    ├── images/synthetic_00000.jpg ...
+    ├── Metadata/{target}_train.csv, {target}_val.csv, {target}_test.csv
+    ├── {target}_guide.csv
+    └── {target}_guide.txt
+
+Images are dark backgrounds with a bright ellipse whose colour depends on the class, roughly like the specimen images.
+The same arguments always produce the same files.
+"""
+
+
+def make_image(rng, label, n_classes, height, width):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:] = rng.randint(0, 6, size=3)
+    yy, xx = np.mgrid[0:height, 0:width]
+    cy, cx = rng.randint(height // 3, 2 * height // 3), rng.randint(width // 3, 2 * width // 3)
+    ry, rx = rng.randint(height // 6, height // 3), rng.randint(width // 6, width // 3)
+    mask = ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    hue = 255 * (label + 1) // (n_classes + 1)
+    colour = np.array([hue, 255 - hue, 128]) + rng.randint(-20, 20, size=3)
+    image[mask] = np.clip(colour, 0, 255)
+    noise = rng.randint(0, 12, size=image.shape)
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def generate(root, n_images=256, n_classes=8, height=300, width=280, target='species', seed=0,
+             split=(0.7, 0.15, 0.15)):
+    """
+    Write the synthetic data set. Existing images with the same name are kept, so regenerating is cheap.
+    :param root: Output directory.
+    :param n_images: Number of images over all splits.
+    :param n_classes: Number of classes, labels are assigned round robin.
+    :param split: Share of the train, val and test csv.
+    :return: Dictionary mapping the phase to its csv path.
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'Metadata'), exist_ok=True)
+    rows = []
+    for idx in range(n_images):
+        label = idx % n_classes
+        name = os.path.join('images', 'synthetic_{:05d}.jpg'.format(idx))
+        # The image is always drawn, so the random stream does not depend on which files already exist
+        pixels = make_image(rng, label, n_classes, height, width)
+        if not os.path.exists(os.path.join(root, name)):
+            Image.fromarray(pixels).save(os.path.join(root, name), quality=90)
+        rows.append([name, label])
+
+    order = rng.permutation(n_images)
+    n_train = int(split[0] * n_images)
+    n_val = int(split[1] * n_images)
+    phases = {'train': order[:n_train], 'val': order[n_train:n_train + n_val], 'test': order[n_train + n_val:]}
+    csv_paths = {}
+    for phase, indices in phases.items():
+        csv_paths[phase] = os.path.join(root, 'Metadata', target + '_' + phase + '.csv')
+        with open(csv_paths[phase], 'w', encoding='ascii', newline='') as f_out:
+            csv.writer(f_out).writerows(rows[i] for i in sorted(indices))
+
+    class_names = ['Synthetic_class{}'.format(i) for i in range(n_classes)]
+    with open(os.path.join(root, target + '_guide.csv'), 'w', encoding='ascii', newline='') as f_guide:
+        csv.writer(f_guide).writerows([name, i] for i, name in enumerate(class_names))
+    with open(os.path.join(root, target + '_guide.txt'), 'w', encoding='ascii') as f_guide:
+        f_guide.write('\n'.join(class_names))
+    return csv_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='./benchmarks/synthetic', help='output directory')
+    parser.add_argument('--images', type=int, default=256, help='number of images')
+    parser.add_argument('--classes', type=int, default=8, help='number of classes')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    opt = parser.parse_args()
+    print(generate(opt.root, opt.images, opt.classes, seed=opt.seed))
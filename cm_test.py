@@ -12,6 +12,7 @@ from torchvision.transforms import ToTensor
 from torch.utils.data import DataLoader
 from PIL import Image
 import matplotlib.pyplot as plt
+from Data_helper import loader_config
 
 # from ray import tune
 # from ray.tune import CLIReporter
@@ -143,12 +144,15 @@ def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
 
 
 # Load train, test and validation data by phase. Phase = train, val and test. Target = genus and species
-def load_data(phase, target, d_transfroms, batch_size=16):
+# loader_kwargs are passed to the DataLoader, see Data_helper.loader_config. Defaults to the auto configuration.
+def load_data(phase, target, d_transfroms, batch_size=16, loader_kwargs=None):
     data_path = './Metadata/' + target + '_' + phase + '.csv'
     src_path = './Plaindata'
     data_out = CustomImageDataset(data_path, src_path, d_transfroms)
     data_size = len(data_out)
-    data_loader = DataLoader(data_out, batch_size=batch_size, shuffle=True)
+    if loader_kwargs is None:
+        loader_kwargs = loader_config()
+    data_loader = DataLoader(data_out, batch_size=batch_size, shuffle=True, **loader_kwargs)
     return data_loader, data_size
 
 
@@ -177,58 +181,60 @@ def testmodel(model):
         print(f'accuracy = {acc}')
 
 
-data_transforms = transforms.Compose([transforms.Resize([256, 256]),
-                                      transforms.CenterCrop([224, 224]),
-                                      transforms.ToTensor(),
-                                      transforms.Normalize(
-                                          mean=[0.485, 0.456, 0.406],
-                                          std=[0.229, 0.224, 0.225])])
-target = 'species'
-dataloaders = {}
-dataset_sizes = {}
-batch_size: int = 15
-dataloaders['train'], dataset_sizes['train'] = load_data('train', target, data_transforms, batch_size)
-dataloaders['val'], dataset_sizes['val'] = load_data('val', target, data_transforms, batch_size)
-dataloaders['test'], dataset_sizes['test'] = load_data('test', target, data_transforms, batch_size)
-dataiter = iter(dataloaders['train'])
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-train_features, train_labels = next(iter(dataloaders['train']))
-print(f"Feature batch shape: {train_features.size()}")
-print(f"Labels batch shape: {train_labels.size()}")
-
-img = train_features[0].squeeze()
-label = train_labels[0]
-unloader = transforms.ToPILImage()
-image = unloader(img)
-plt.imshow(image)
-print(device)
-
-model_ft = models.resnet152(pretrained=True)
-
-# model_ft.classifier[6] = torch.nn.Linear(4096,15)
-
-num_ftrs = model_ft.fc.in_features
-model_ft.fc = torch.nn.Linear(num_ftrs, 15)
-
-model_ft = model_ft.to(device)
-
-# Observe that all parameters are being optimized
-optimizer_ft = torch.optim.SGD(model_ft.parameters(), lr=0.001, momentum=0.9)
-'''Need a parameter searching grid'''
-exp_lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer_ft, step_size=5, gamma=0.5)
-criterion = torch.nn.CrossEntropyLoss()
-model_ft = train_model(model_ft, criterion, optimizer_ft,
-                       exp_lr_scheduler, num_epochs=20)
-
-# test
-# model = models.resnet152(pretrained=True)
-# num_ftrs = model.fc.in_features
-# model.fc = torch.nn.Linear(num_ftrs, 31)
-
-# model = models.vgg16(pretrained=True)
-# model.classifier[6] = torch.nn.Linear(4096,31)
-# model.load_state_dict(torch.load('./Models/vgg16 1626284118.0475392.pth'))
-# model.eval()
-# model = model.to(device)
-# testmodel(model)
+# Guarded so that DataLoader workers started with spawn do not run the training again
+if __name__ == '__main__':
+    data_transforms = transforms.Compose([transforms.Resize([256, 256]),
+                                          transforms.CenterCrop([224, 224]),
+                                          transforms.ToTensor(),
+                                          transforms.Normalize(
+                                              mean=[0.485, 0.456, 0.406],
+                                              std=[0.229, 0.224, 0.225])])
+    target = 'species'
+    dataloaders = {}
+    dataset_sizes = {}
+    batch_size: int = 15
+    dataloaders['train'], dataset_sizes['train'] = load_data('train', target, data_transforms, batch_size)
+    dataloaders['val'], dataset_sizes['val'] = load_data('val', target, data_transforms, batch_size)
+    dataloaders['test'], dataset_sizes['test'] = load_data('test', target, data_transforms, batch_size)
+    dataiter = iter(dataloaders['train'])
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    train_features, train_labels = next(iter(dataloaders['train']))
+    print(f"Feature batch shape: {train_features.size()}")
+    print(f"Labels batch shape: {train_labels.size()}")
+
+    img = train_features[0].squeeze()
+    label = train_labels[0]
+    unloader = transforms.ToPILImage()
+    image = unloader(img)
+    plt.imshow(image)
+    print(device)
+
+    model_ft = models.resnet152(pretrained=True)
+
+    # model_ft.classifier[6] = torch.nn.Linear(4096,15)
+
+    num_ftrs = model_ft.fc.in_features
+    model_ft.fc = torch.nn.Linear(num_ftrs, 15)
+
+    model_ft = model_ft.to(device)
+
+    # Observe that all parameters are being optimized
+    optimizer_ft = torch.optim.SGD(model_ft.parameters(), lr=0.001, momentum=0.9)
+    '''Need a parameter searching grid'''
+    exp_lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer_ft, step_size=5, gamma=0.5)
+    criterion = torch.nn.CrossEntropyLoss()
+    model_ft = train_model(model_ft, criterion, optimizer_ft,
+                           exp_lr_scheduler, num_epochs=20)
+
+    # test
+    # model = models.resnet152(pretrained=True)
+    # num_ftrs = model.fc.in_features
+    # model.fc = torch.nn.Linear(num_ftrs, 31)
+
+    # model = models.vgg16(pretrained=True)
+    # model.classifier[6] = torch.nn.Linear(4096,31)
+    # model.load_state_dict(torch.load('./Models/vgg16 1626284118.0475392.pth'))
+    # model.eval()
+    # model = model.to(device)
+    # testmodel(model)
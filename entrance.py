@@ -1,11 +1,12 @@
+import os
+import time
 import argparse
-import torch
-from torchvision import models
-from Train import single_train
+from Model_registry import determine_model, get_head, model_names
 
 """
 This is an entrance for receiving terminal command lines and 
 calling training functions according to specified model and hyper-parameters.
+torch and the training modules are imported when training starts, so --help and --list-models return instantly.
 """
 
 parser = argparse.ArgumentParser()
@@ -24,7 +25,10 @@ parser.add_argument("--epochs",
 parser.add_argument("--model",
                     type=str,
                     default='resnet50',
-                    help="The model for training. For example: resnet152.")
+                    help="The model for training. For example: resnet152. See --list-models.")
+parser.add_argument("--list-models",
+                    action='store_true',
+                    help="Print the available models and exit.")
 parser.add_argument("--target",
                     type=str,
                     default='species',
@@ -65,63 +69,99 @@ parser.add_argument("--lambd",
                     type=float,
                     default=0.1,
                     help="The lambda for the optimizer, should be float.")
-args = parser.parse_args()
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print('Using ', device, '.')
-
-
-def determine_model(arg_model, arg_pretrain, arg_classes):
-    if arg_model.lower() == 'resnet18':
-        model = models.resnet18(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'resnet34':
-        model = models.resnet34(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'resnet101':
-        model = models.resnet101(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'resnet152':
-        model = models.resnet152(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'vgg16':
-        model = models.vgg16(pretrained=arg_pretrain)
-        model.classifier[6] = torch.nn.Linear(in_features=4096, out_features=arg_classes)
-    elif arg_model.lower() == 'vgg19':
-        model = models.vgg19(pretrained=arg_pretrain)
-        model.classifier[6] = torch.nn.Linear(in_features=4096, out_features=arg_classes)
-    elif arg_model.lower() == 'efficientnet':
-        model = models.efficientnet_b4(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'convnext_tiny':
-        model = models.convnext_tiny(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    elif arg_model.lower() == 'convnext_large':
-        model = models.convnext_large(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    elif arg_model.lower() == 'regnet_y_16gf':
-        model = models.regnet_y_16gf(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'vit_b_16':
-        model = models.vit_b_16(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    elif arg_model.lower()=='efficient_v2':
-        model = models.efficientnet_v2_l(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    else:
-        model = models.resnet50(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    return model
+parser.add_argument("--cache_dir",
+                    type=str,
+                    default=None,
+                    help="Directory for the pre-decoded image cache. Images are resized once and memory-mapped.")
+parser.add_argument("--num_workers",
+                    type=str,
+                    default='auto',
+                    help="DataLoader worker processes, an integer or auto to size it from the cpu count.")
+parser.add_argument("--prefetch_factor",
+                    type=int,
+                    default=2,
+                    help="Batches loaded in advance by each DataLoader worker.")
+parser.add_argument("--no_persistent_workers",
+                    action='store_true',
+                    help="Re-create the DataLoader workers every epoch.")
+parser.add_argument("--pin_memory",
+                    type=str,
+                    default='auto',
+                    choices=['auto', 'on', 'off'],
+                    help="Pin batches in page-locked memory, auto enables it when cuda is available.")
+parser.add_argument("--pin_threads",
+                    action='store_true',
+                    help="Pin every DataLoader worker to a single cpu core.")
+parser.add_argument("--share_annotations",
+                    action='store_true',
+                    help="Keep the annotation index in shared memory for the DataLoader workers.")
+parser.add_argument("--precision",
+                    type=str,
+                    default='fp32',
+                    choices=['fp32', 'bf16'],
+                    help="Numeric precision of forward pass and loss. bf16 uses torch.autocast with bfloat16.")
+parser.add_argument("--memory_format",
+                    type=str,
+                    default='contiguous',
+                    choices=['contiguous', 'channels_last'],
+                    help="Memory layout of model and input batches.")
+parser.add_argument("--progressive_resize",
+                    type=str,
+                    default=None,
+                    help="Progressive resizing schedule as size:epochs pairs, e.g. 128:3,176:3 trains 3 epochs at 128px, "
+                         "3 epochs at 176px and the rest at full resolution. Validation always uses full resolution.")
+parser.add_argument("--async_validation",
+                    action='store_true',
+                    help="Validate in a separate process while the next epoch trains. Early stopping and the best "
+                         "weights then see the validation results at most one epoch late.")
+parser.add_argument("--checkpoint_dir",
+                    type=str,
+                    default='./Models/',
+                    help="Directory for the periodic training checkpoints.")
+parser.add_argument("--checkpoint_every",
+                    type=int,
+                    default=1,
+                    help="Write a checkpoint every n epochs, 0 disables checkpoints.")
+parser.add_argument("--resume",
+                    type=str,
+                    default=None,
+                    help="Checkpoint to continue training from. New checkpoints are written to the same file.")
+parser.add_argument("--nproc",
+                    type=int,
+                    default=1,
+                    help="Number of data-parallel training processes (gloo backend), the cpu cores are split evenly.")
+parser.add_argument("--freeze_backbone",
+                    action='store_true',
+                    help="Only train the classification head on backbone features computed once and cached.")
+parser.add_argument("--feature_dir",
+                    type=str,
+                    default='./Features/',
+                    help="Directory of the cached backbone features for --freeze_backbone.")
+parser.add_argument("--search_trials",
+                    type=int,
+                    default=0,
+                    help="Run a hyper-parameter search over lr, batch_size, step_size, gamma and momentum with this "
+                         "many trials instead of a single training, see Hyper_search.py.")
+parser.add_argument("--search_parallel",
+                    type=int,
+                    default=2,
+                    help="Number of concurrent search trials, the cpu cores are split evenly between them.")
+parser.add_argument("--search_grace",
+                    type=int,
+                    default=1,
+                    help="Epochs every search trial runs before successive halving can stop it.")
+parser.add_argument("--search_eta",
+                    type=int,
+                    default=3,
+                    help="Successive halving factor, only the top 1/eta of the trials continues at every rung.")
+parser.add_argument("--search_seed",
+                    type=int,
+                    default=0,
+                    help="Random seed of the sampled search configurations.")
 
 
 def determine_optimizer(model, arg_optimizer, arg_lr, arg_momentum, arg_lambda):
+    import torch
     if arg_optimizer.lower() == 'ASGD':
         optimizer = torch.optim.ASGD(model.parameters(), lr=arg_lr, lambd=arg_lambda)
     else:
@@ -130,10 +170,12 @@ def determine_optimizer(model, arg_optimizer, arg_lr, arg_momentum, arg_lambda):
 
 
 def determine_criterion(arg_criterion):
+    import torch
     return torch.nn.CrossEntropyLoss()
 
 
 def determine_scheduler(optimizer, arg_scheduler, arg_step_size, arg_gamma):
+    import torch
     if arg_scheduler.lower() == 'steplr':
         scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=arg_step_size, gamma=arg_gamma)
     elif arg_scheduler.lower() == 'exponentiallr':
@@ -143,21 +185,91 @@ def determine_scheduler(optimizer, arg_scheduler, arg_step_size, arg_gamma):
     return scheduler
 
 
-model = determine_model(args.model, args.pretrained, args.classes)
-model = model.to(device)
-optimizer = determine_optimizer(model,args.optimizer,args.lr, args.momentum, args.lambd)
-criterion = determine_criterion(args.criterion)
-scheduler = determine_scheduler(optimizer, args.scheduler, args.step_size, args.gamma)
-
-try:
-    model, save_path = single_train(model=model, target=args.target, batch_size=args.batch_size,
-                                n_epochs=args.epochs, criterion=criterion, optimizer=optimizer,
-                                scheduler=scheduler)
-    save_path = save_path+'_'+args.target+'_'+args.model+'.pth'
-    torch.save(model.state_dict(), save_path)
-except Exception as e:
-    print(str(e))
-    exit('Training failed.')
+def train(rank, nproc, args, checkpoint_path, metrics_path):
+    """
+    Build model, optimizer, criterion and scheduler from the command line arguments and train the model. With --nproc
+    this runs in every gloo worker, rank and nproc identify the worker.
+    """
+    import torch
+    from Train import single_train
+    from Data_helper import loader_config, parse_resize_schedule
+    from Distributed_helper import is_main_process, unwrap_model
+    from Feature_cache import frozen_train
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('Using ', device, '.')
+
+    model = determine_model(args.model, args.pretrained, args.classes)
+    model = model.to(device)
+    # With a frozen backbone only the head is optimized
+    trained = get_head(model, args.model) if args.freeze_backbone else model
+    optimizer = determine_optimizer(trained,args.optimizer,args.lr, args.momentum, args.lambd)
+    criterion = determine_criterion(args.criterion)
+    scheduler = determine_scheduler(optimizer, args.scheduler, args.step_size, args.gamma)
+    loader_kwargs = loader_config(num_workers=args.num_workers, persistent_workers=not args.no_persistent_workers,
+                                  prefetch_factor=args.prefetch_factor, pin_memory=args.pin_memory,
+                                  pin_threads=args.pin_threads)
+
+    resize_schedule = parse_resize_schedule(args.progressive_resize) if args.progressive_resize else None
+
+    if args.freeze_backbone:
+        model, save_path = frozen_train(model=model, model_name=args.model, target=args.target,
+                                        batch_size=args.batch_size, n_epochs=args.epochs, criterion=criterion,
+                                        optimizer=optimizer, scheduler=scheduler, feature_dir=args.feature_dir,
+                                        loader_kwargs=loader_kwargs, checkpoint_path=checkpoint_path,
+                                        checkpoint_every=args.checkpoint_every, resume=args.resume,
+                                        metrics_path=metrics_path)
+    else:
+        model, save_path = single_train(model=model, target=args.target, batch_size=args.batch_size,
+                                        n_epochs=args.epochs, criterion=criterion, optimizer=optimizer,
+                                        scheduler=scheduler, cache_dir=args.cache_dir, loader_kwargs=loader_kwargs,
+                                        share_memory=args.share_annotations, precision=args.precision,
+                                        memory_format=args.memory_format, checkpoint_path=checkpoint_path,
+                                        checkpoint_every=args.checkpoint_every, resume=args.resume,
+                                        metrics_path=metrics_path, resize_schedule=resize_schedule,
+                                        async_validation=args.async_validation)
+    if is_main_process():
+        save_path = save_path+'_'+args.target+'_'+args.model+'.pth'
+        torch.save(unwrap_model(model).state_dict(), save_path)
+
+
+# Guarded so that DataLoader workers started with spawn do not run the training again
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.list_models:
+        print('\n'.join(model_names()))
+        exit()
+    if args.freeze_backbone and args.nproc > 1:
+        parser.error('--freeze_backbone trains in a single process, it cannot be combined with --nproc.')
+    if args.freeze_backbone and args.progressive_resize:
+        parser.error('--progressive_resize trains the backbone, it cannot be combined with --freeze_backbone.')
+    if args.async_validation and (args.nproc > 1 or args.freeze_backbone):
+        parser.error('--async_validation cannot be combined with --nproc or --freeze_backbone.')
+    if args.search_trials > 0 and (args.nproc > 1 or args.freeze_backbone or args.resume is not None):
+        parser.error('--search_trials cannot be combined with --nproc, --freeze_backbone or --resume.')
+    if args.search_trials > 0:
+        from Hyper_search import search
+        search(args, args.search_trials, args.search_parallel)
+        exit()
+
+    if args.resume is not None:
+        checkpoint_path = args.resume
+    else:
+        checkpoint_path = os.path.join(args.checkpoint_dir, str(int(time.time())) + '_' + args.target + '_' +
+                                       args.model + '_checkpoint.pth')
+    from Train import PATH
+    from Distributed_helper import run_distributed
+    # Throughput records are kept next to the saved models
+    metrics_path = PATH + str(int(time.time())) + '_' + args.target + '_' + args.model + '_metrics.jsonl'
+
+    try:
+        if args.nproc > 1:
+            run_distributed(args.nproc, train, args, checkpoint_path, metrics_path)
+        else:
+            train(0, 1, args, checkpoint_path, metrics_path)
+    except Exception as e:
+        print(str(e))
+        exit('Training failed.')
 
 # arg = sys.argv[1:]
 # l = ['model', 'target', 'n_class', 'phase', 'pretrained', 'batch_size', 'n_epochs', 'criterion', 'optimizer',
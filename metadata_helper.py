@@ -3,40 +3,27 @@
 from PIL import Image
 import os
 import csv
+import argparse
+import numpy as np
 import pandas as pd
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
+# Threads reading image headers in get_all_size, the work is file io
+SIZE_THREADS = 16
 
-def read_image_size(img):
-    return img.size
 
+def read_image_size(dir_im):
+    # PIL parses only the header on open, the pixels are never decoded
+    with Image.open(dir_im) as img:
+        return img.size
 
-def read_image_file(dir_im):
-    return Image.open(dir_im).convert('RGB')
 
-
-def load_csv(in_path):
-    rows = []
-    img_species = {}
-    img_genuses = {}
-    with open(in_path, 'r', encoding='ascii', errors='ignore') as f_in:
-        csv_reader = csv.reader(f_in, delimiter=',')
-        row1 = next(csv_reader)
-        for row in csv_reader:
-            row_copy = row.copy()
-            img_class = row[1]
-            if img_class not in img_species:
-                img_species[img_class] = 0
-            img_species[img_class] += 1
-            image_genus = row_copy[1].split('_')[0]
-            if image_genus not in img_genuses:
-                img_genuses[image_genus] = 0
-            img_genuses[image_genus] += 1
-            rows.append(row)
-    return rows, row1, img_species, img_genuses
-
-
-def get_all_size(in_path, out_path, data_path):
+def get_all_size(in_path, out_path, data_path, threads=SIZE_THREADS):
+    '''
+    Write in_path with the width and height of every image to out_path. Sizes are read from the image headers on a
+    thread pool, the rows keep the order of in_path.
+    :return: Dictionary of class: image count.
+    '''
     img_classes = {}
     with open(in_path, 'r', encoding='ascii', errors='ignore') as f_in, open(out_path, 'w', encoding='ascii',
                                                                              errors='ignore') as f_out:
@@ -49,77 +36,79 @@ def get_all_size(in_path, out_path, data_path):
 
         writer.writerow(row1)
 
-        for row in csv_reader:
-            row_copy = row.copy()
-            img_dir = os.path.join(data_path, row[0])
-            img_class = row[1]
-            if img_class not in img_classes:
-                img_classes[img_class] = 0
-            img_classes[img_class] += 1
-            img = read_image_file(img_dir)
-            width, height = read_image_size(img)
-            row_copy.append(width)
-            row_copy.append(height)
-            writer.writerow(row_copy)
+        rows = list(csv_reader)
+        with ThreadPoolExecutor(threads) as pool:
+            # map yields in the order of the rows
+            sizes = pool.map(read_image_size, [os.path.join(data_path, row[0]) for row in rows])
+            for row, (width, height) in zip(rows, sizes):
+                row_copy = row.copy()
+                img_class = row[1]
+                if img_class not in img_classes:
+                    img_classes[img_class] = 0
+                img_classes[img_class] += 1
+                row_copy.append(width)
+                row_copy.append(height)
+                writer.writerow(row_copy)
     f_in.close()
     f_out.close()
     return img_classes
 
 
-def label_genus(in_path, out_path, guide_path, treshold=20):
-    genus_collection = {}
-    base_count = 0
-    rows, row1, img_species, img_genuses = load_csv(in_path)
+def factorize_labels(labels, minimum):
+    '''
+    Number the classes of labels in order of first appearance, leaving out classes with less than minimum images.
+    :param labels: Array-like of class names, one per image.
+    :return: (boolean mask of the kept images, class numbers of the kept images, class names by number)
+    '''
+    codes, uniques = pd.factorize(np.asarray(labels, dtype=object))
+    kept_classes = np.bincount(codes, minlength=len(uniques)) >= minimum
+    keep = kept_classes[codes]
+    # Dropped classes are skipped in the numbering, the order of first appearance stays
+    renumber = np.cumsum(kept_classes) - 1
+    return keep, renumber[codes[keep]], list(uniques[kept_classes])
+
+
+def _write_labels(rows, labels, out_path, guide_path, minimum):
+    keep, codes, classes = factorize_labels(labels, minimum)
+    rows = rows[keep]
+    rows[:, 1] = codes
     with open(out_path, 'w', encoding='ascii', errors='ignore') as f_out:
-        writer = csv.writer(f_out)
-        for row in rows:
-            row_copy = row.copy()
-            genus = row_copy[1].split('_')[0]
-            if img_genuses[genus] <= treshold:
-                continue
-            if genus not in genus_collection:
-                genus_collection[genus] = base_count
-                base_count += 1
-            row_copy[1] = genus_collection[genus]
-            writer.writerow(row_copy)
-    f_out.close()
+        csv.writer(f_out).writerows(rows)
     with open(guide_path, 'w', encoding='ascii', errors='ignore') as f_guide:
-        writer = csv.writer(f_guide)
-        for k, v in genus_collection.items():
-            row = []
-            row.append(k)
-            row.append(v)
-            writer.writerow(row)
-    f_guide.close()
+        csv.writer(f_guide).writerows(zip(classes, range(len(classes))))
 
 
-def label_species(in_path, out_path, guide_path, treshold=20):
-    species_collection = {}
-    base_count = 0
-    rows, row1, img_species, img_genuses = load_csv(in_path)
-    with open(out_path, 'w', encoding='ascii', errors='ignore') as f_out:
-        writer = csv.writer(f_out)
-        for row in rows:
-            row_copy = row.copy()
-            species = row_copy[1]
-            if img_species[species] <= treshold:
-                continue
-            if species not in species_collection:
-                species_collection[species] = base_count
-                base_count += 1
-            row_copy[1] = species_collection[species]
-            writer.writerow(row_copy)
-    f_out.close()
-    with open(guide_path, 'w', encoding='ascii', errors='ignore') as f_guide:
-        writer = csv.writer(f_guide)
-        for k, v in species_collection.items():
-            row = []
-            row.append(k)
-            row.append(v)
-            writer.writerow(row)
-    f_guide.close()
+def read_labels(in_path):
+    '''
+    :return: (rows of in_path without the header as an object array, species column, genus column)
+    '''
+    with open(in_path, 'r', encoding='ascii', errors='ignore') as f_in:
+        df = pd.read_csv(f_in, dtype=str, keep_default_na=False)
+    species = df.iloc[:, 1]
+    genus = species.str.split('_', n=1).str[0]
+    return df.to_numpy(dtype=object), species.to_numpy(dtype=object), genus.to_numpy(dtype=object)
+
+
+def label_all(in_path, species_path='species.csv', species_guide_path='species_guide.csv', genus_path='genus.csv',
+              genus_guide_path='genus_guide.csv', treshold=20):
+    '''
+    Write the species and genus label files of in_path with one read of the csv. Classes with treshold or fewer
+    images are left out, the others are numbered in order of first appearance.
+    '''
+    rows, species, genus = read_labels(in_path)
+    _write_labels(rows.copy(), species, species_path, species_guide_path, treshold + 1)
+    _write_labels(rows, genus, genus_path, genus_guide_path, treshold + 1)
 
 
+def label_genus(in_path, out_path, guide_path, treshold=20):
+    rows, _, genus = read_labels(in_path)
+    _write_labels(rows, genus, out_path, guide_path, treshold + 1)
+
+
+def label_species(in_path, out_path, guide_path, treshold=20):
+    rows, species, _ = read_labels(in_path)
+    _write_labels(rows, species, out_path, guide_path, treshold + 1)
+
 
 def image_by_source():
     '''
@@ -166,78 +155,52 @@ def windows2linux(file):
     return file
 
 def build_label_csv(image_path, species_class_path, genus_class_path, threashold = 10, linux=False):
-    all_species_labels = []
+    '''
+    Label the images of image_path/<Genus species>/ in one pass. Writes ostracods_species.csv, ostracods_genus.csv and
+    their guide txt files, classes with less than threashold images are left out.
+    '''
     all_files = []
-    all_genus_labels = []
-    all_classes = os.listdir(image_path)
-    f_species = open(species_class_path, 'r', encoding='ascii')
-    species_classes = f_species.read().splitlines()
-    f_species.close()
-    f_genus = open(genus_class_path, 'r', encoding='ascii')
-    genus_classes = f_genus.read().splitlines()
-    f_genus.close()
-    for classe in all_classes:
-        species = classe
-        genus = classe.split(' ')[0]
-        walk_in = os.path.join(image_path, classe)
-        files = os.listdir(walk_in)
-        full_file_path = [os.path.join(walk_in,f) for f in files]
-        species_label = replica(species, len(files))
-        genus_label = replica(genus,len(files))
-        all_files+=full_file_path
-        all_species_labels+=species_label
-        all_genus_labels+=genus_label
-    species_count = Counter(all_species_labels)
-    genus_count = Counter(all_genus_labels)
-    true_genus = []
-    true_spceies = []
-    for species in species_count:
-        if species_count[species] >= threashold:
-            true_spceies.append(species)
-    for genus in genus_count:
-        if genus_count[genus] >= threashold:
-            true_genus.append(genus)
-    if linux is True:
-        all_files_rep = all_files.copy()
-        all_files = [windows2linux(f) for f in all_files_rep]
-        del all_files_rep
-    with open('ostracods_species_guide.txt', 'w',encoding='ascii') as f_out:
-        f_out.write('\n'.join(true_spceies))
-    f_out.close()
-    with open('ostracods_genus_guide.txt', 'w', encoding='ascii') as f_out:
-        f_out.write('\n'.join(true_genus))
-    f_out.close()
-    with open('ostracods_species.csv', 'w', encoding='ascii', newline='') as sp_out:
-        writer = csv.writer(sp_out)
-        for file, label in zip(all_files, all_species_labels):
-            if species_count[label] < threashold:
-                print(label, 'has less than 10 images, skip.')
-                continue
-            row = []
-            row.append(file)
-            row.append(true_spceies.index(label))
-            writer.writerow(row)
-    sp_out.close()
-    with open('ostracods_genus.csv', 'w', encoding='ascii', newline='') as ge_out:
-        writer = csv.writer(ge_out)
-        for file, label in zip(all_files, all_genus_labels):
-            if genus_count[label] < threashold:
-                print(label, 'has less than 10 images, skip.')
+    all_species_labels = []
+    with os.scandir(image_path) as classes:
+        for classe in classes:
+            if not classe.is_dir():
                 continue
-            row = []
-            row.append(file)
-            row.append(true_genus.index(label))
-            writer.writerow(row)
-    ge_out.close()
+            with os.scandir(classe.path) as files:
+                full_file_path = [f.path for f in files if f.is_file()]
+            all_files += full_file_path
+            all_species_labels += replica(classe.name, len(full_file_path))
+    all_species_labels = np.array(all_species_labels, dtype=object)
+    all_genus_labels = np.array([species.split(' ')[0] for species in all_species_labels], dtype=object)
+    if linux is True:
+        all_files = [windows2linux(f) for f in all_files]
+    all_files = np.array(all_files, dtype=object)
+    for level, labels in [('species', all_species_labels), ('genus', all_genus_labels)]:
+        keep, codes, true_classes = factorize_labels(labels, threashold)
+        for label in pd.unique(labels[~keep]):
+            print(label, 'has less than {} images, skip.'.format(threashold))
+        with open('ostracods_' + level + '_guide.txt', 'w', encoding='ascii') as f_out:
+            f_out.write('\n'.join(true_classes))
+        with open('ostracods_' + level + '.csv', 'w', encoding='ascii', newline='') as f_out:
+            csv.writer(f_out).writerows(zip(all_files[keep], codes))
 
 if __name__ == '__main__':
-    # flag = 1
-    # if flag ==0:
-    #     treshold = 20
-    #     classes = load_csv('input.csv', 'output.csv', './Plaindata')
-    #     print(classes)
-    #     label_genus('input.csv', 'genus.csv', 'genus_guide.csv')
-    #     label_species('input.csv', 'species.csv', 'species_guide.csv')
-    # image_by_source()
-    build_label_csv('E:\data\ostracods_id\class_images', 'D:\Competetion_data\Ostracods_data\species_classes.txt',
-                    'D:\Competetion_data\Ostracods_data\genus_classes.txt', linux=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset",
+                        nargs='?',
+                        default='ostracods',
+                        choices=['forams', 'ostracods'],
+                        help="forams: sizes and all label files of input.csv, ostracods: labels of the class folders.")
+    parser.add_argument("--treshold",
+                        type=int,
+                        default=20,
+                        help="Forams classes with this many images or fewer are left out.")
+    args = parser.parse_args()
+    if args.dataset == 'forams':
+        classes = get_all_size('input.csv', 'output.csv', './Plaindata')
+        print(classes)
+        label_all('input.csv', treshold=args.treshold)
+    else:
+        # image_by_source()
+        build_label_csv('E:\data\ostracods_id\class_images',
+                        'D:\Competetion_data\Ostracods_data\species_classes.txt',
+                        'D:\Competetion_data\Ostracods_data\genus_classes.txt', linux=True)
@@ -1,8 +1,6 @@
+import os
 import argparse
-from Train import test_model
-import torch
-from torchvision import models
-from Classification_helper import plot_prediction
+from Model_registry import determine_model, model_names
 
 '''
     Default model in case no parameter of model provided.
@@ -15,55 +13,6 @@ MODEL_PATH = '1643965937_0.92_genus_vgg16.pth'
 RESULT_BASE = 'Results/'
 RESULT_PATH = '1644219241_genus_vgg16_result.csv'
 
-def determine_model(arg_model, arg_pretrain, arg_classes):
-    if arg_model.lower() == 'resnet18':
-        model = models.resnet18(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'resnet34':
-        model = models.resnet34(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'resnet101':
-        model = models.resnet101(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'resnet152':
-        model = models.resnet152(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'vgg16':
-        model = models.vgg16(pretrained=arg_pretrain)
-        model.classifier[6] = torch.nn.Linear(in_features=4096, out_features=arg_classes)
-    elif arg_model.lower() == 'vgg19':
-        model = models.vgg19(pretrained=arg_pretrain)
-        model.classifier[6] = torch.nn.Linear(in_features=4096, out_features=arg_classes)
-    elif arg_model.lower() == 'efficientnet':
-        model = models.efficientnet_b4(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'convnext_tiny':
-        model = models.convnext_tiny(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    elif arg_model.lower() == 'convnext_large':
-        model = models.convnext_large(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    elif arg_model.lower() == 'regnet_y_16gf':
-        model = models.regnet_y_16gf(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    elif arg_model.lower() == 'vit_b_16':
-        model = models.vit_b_16(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    elif arg_model.lower()=='efficient_v2':
-        model = models.efficientnet_v2_l(pretrained=arg_pretrain)
-        model.num_classes = arg_classes
-    else:
-        model = models.resnet50(pretrained=arg_pretrain)
-        num_ftrs = model.fc.in_features
-        model.fc = torch.nn.Linear(num_ftrs, arg_classes)
-    return model
-
 parser = argparse.ArgumentParser()
 parser.add_argument("--model_path",
                     type=str,
@@ -72,7 +21,10 @@ parser.add_argument("--model_path",
 parser.add_argument("--model",
                     type=str,
                     default='resnet50',
-                    help="Model for your classification task.")
+                    help="Model for your classification task. See --list-models.")
+parser.add_argument("--list-models",
+                    action='store_true',
+                    help="Print the available models and exit.")
 parser.add_argument("--pretrained",
                     type=bool,
                     default=False,
@@ -84,8 +36,58 @@ parser.add_argument("--classes",
 parser.add_argument("--mode",
                     type=str,
                     default='test',
-                    help="The mode for running the programme. Test for doing inference and cm for getting the "
-                         "confusion matrix.")
+                    help="The mode for running the programme. Test for doing inference, cm for getting the "
+                         "confusion matrix, export for exporting the model to a TorchScript or ONNX artifact, "
+                         "quantize for an int8 model, predict for classifying all images under --image_dir and ensemble for "
+                         "running the --ensemble models together.")
+parser.add_argument("--ensemble",
+                    type=str,
+                    nargs='+',
+                    default=None,
+                    help="Models of the ensemble mode as [name=]model:path, path is a checkpoint in Models/ or an "
+                         "exported .pt/.onnx artifact. All must be trained for --target.")
+parser.add_argument("--ensemble_phase",
+                    type=str,
+                    default='test',
+                    choices=['test', 'val'],
+                    help="Csv of Metadata/ classified by the ensemble mode.")
+parser.add_argument("--image_dir",
+                    type=str,
+                    default=None,
+                    help="Directory tree of unlabeled images for the predict mode.")
+parser.add_argument("--output",
+                    type=str,
+                    default=None,
+                    help="Prediction csv of the predict mode. Images already in it are skipped, so a run can be "
+                         "continued. Defaults to Results/<image_dir name>_<target>_<model>_predictions.csv.")
+parser.add_argument("--top_k",
+                    type=int,
+                    default=0,
+                    help="Add the k most probable classes and their probabilities to every row of the result file.")
+parser.add_argument("--output_format",
+                    type=str,
+                    default='csv',
+                    choices=['csv', 'parquet'],
+                    help="Format of the result file, parquet needs pyarrow.")
+parser.add_argument("--artifact_path",
+                    type=str,
+                    default=None,
+                    help="Exported artifact. In test mode inference runs on it instead of the eager model, in export "
+                         "mode it is the output file (default: the model path with .pt or .onnx).")
+parser.add_argument("--export_format",
+                    type=str,
+                    default=None,
+                    choices=['torchscript', 'onnx'],
+                    help="Format of the export mode, defaults to onnx when onnxruntime is installed, else torchscript.")
+parser.add_argument("--quantization",
+                    type=str,
+                    default='static',
+                    choices=['dynamic', 'static'],
+                    help="Quantize mode: dynamic int8 Linear layers, or static int8 calibrated on the val csv.")
+parser.add_argument("--calibration_images",
+                    type=int,
+                    default=256,
+                    help="Images of the val csv used to calibrate static quantization.")
 parser.add_argument("--result_path",
                     type=str,
                     default=RESULT_PATH,
@@ -99,16 +101,84 @@ parser.add_argument("--target",
                     default='species',
                     help="The count of classes for classification.")
 
-args = parser.parse_args()
-if args.mode == 'cm':
-    # for producing confusion matrix
-    result_dir = RESULT_BASE+args.result_path
-    plot_prediction(result_dir, args.target, args.show_plot)
-else:
-    # for classification using the models
-    model_info = args.model
-    model = determine_model(model_info, args.pretrained, args.classes)
-    target = args.target
-    model_dir = MODEL_BASE+args.model_path
-    print(model_dir)
-    test_model(model, model_dir, target, model_info, args.mode)
\ No newline at end of file
+
+def load_trained_model(model_name, path, classes):
+    """
+    :param path: State dict saved by entrance.py, or an artifact of the export/quantize modes.
+    :return: Eval mode model on cpu.
+    """
+    if path.endswith('.pth'):
+        import torch
+        model = determine_model(model_name, False, classes)
+        model.load_state_dict(torch.load(path, map_location='cpu'))
+        return model.eval()
+    from Export_helper import load_artifact
+    return load_artifact(path)
+
+
+def main(args):
+    # torch and the plotting libraries are only imported for the selected mode
+    if args.mode == 'cm':
+        from Classification_helper import plot_prediction
+        # for producing confusion matrix
+        result_dir = RESULT_BASE+args.result_path
+        plot_prediction(result_dir, args.target, args.show_plot)
+    elif args.mode == 'export':
+        from Export_helper import export_checkpoint
+        model = determine_model(args.model, args.pretrained, args.classes)
+        export_checkpoint(model, MODEL_BASE+args.model_path, args.artifact_path, args.target, args.export_format)
+    elif args.mode == 'quantize':
+        from Quantize_helper import quantize_checkpoint
+        # the int8 model is saved as TorchScript, run it with --artifact_path
+        model = determine_model(args.model, args.pretrained, args.classes)
+        quantize_checkpoint(model, MODEL_BASE+args.model_path, args.target, args.model, args.quantization,
+                            n_calibration=args.calibration_images, quantized_path=args.artifact_path)
+    elif args.mode == 'predict':
+        from Directory_predictor import predict_directory
+        model = load_trained_model(args.model, args.artifact_path or MODEL_BASE+args.model_path, args.classes)
+        output = args.output or RESULT_BASE + os.path.basename(os.path.normpath(args.image_dir)) + '_' + \
+            args.target + '_' + args.model + '_predictions.csv'
+        predict_directory(model, args.image_dir, args.target, output, top_k=max(1, args.top_k))
+    elif args.mode == 'ensemble':
+        import torch
+        from Train import load_data, data_transforms
+        from Classification_helper import verify_ensemble
+        models = {}
+        for spec in args.ensemble:
+            name, _, spec = spec.rpartition('=')
+            model_name, _, path = spec.partition(':')
+            name = name or model_name
+            if name in models:
+                # same architecture twice, e.g. two seeds
+                name += '_' + str(len(models))
+            models[name] = load_trained_model(model_name, path if os.path.exists(path) else MODEL_BASE+path,
+                                              args.classes)
+        test_data, data_size = load_data(args.ensemble_phase, args.target, data_transforms)
+        verify_ensemble(models, test_data, torch.device('cpu'), args.target, data_size, args.output_format)
+    elif args.artifact_path is not None:
+        from Export_helper import test_artifact
+        # the exported artifact replaces the eager model
+        test_artifact(args.artifact_path, args.target, args.model, args.mode, top_k=args.top_k,
+                      output_format=args.output_format)
+    else:
+        from Train import test_model
+        # for classification using the models
+        model_info = args.model
+        model = determine_model(model_info, args.pretrained, args.classes)
+        target = args.target
+        model_dir = MODEL_BASE+args.model_path
+        print(model_dir)
+        test_model(model, model_dir, target, model_info, args.mode, top_k=args.top_k,
+                   output_format=args.output_format)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.list_models:
+        print('\n'.join(model_names()))
+        exit()
+    if args.mode == 'predict' and args.image_dir is None:
+        parser.error('--image_dir is required for --mode predict')
+    if args.mode == 'ensemble' and not args.ensemble:
+        parser.error('--mode ensemble needs the models in --ensemble')
+    main(args)